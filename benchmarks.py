@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+__all__=[
+    "BENCHMARKS",
+    "compare_results",
+    "measure_import_time",
+    "run_benchmarks",
+]
+
+#dependencies that are slow to import
+HEAVY_MODULES=["matplotlib","astropy","scipy"]
+
+
+def measure_import_time(module,repeat=5):
+    """
+    Measure the time to import a module of the package in a new
+    interpreter, and which heavy dependencies the import loads.
+
+    Parameters
+    ----------
+    module: str
+        Name of the module, e.g. "dataset" or "utils".
+    repeat: int
+        Number of new interpreters used. The minimum time is returned.
+
+    Returns
+    -------
+    result: dict
+        Dictionary with the import time in seconds ("time") and the list
+        of heavy dependencies loaded ("heavy_modules").
+    """
+
+    package=__name__.rpartition(".")[0]
+    full_name=f"{package}.{module}" if package!="" else module
+    code=(
+        "import sys,time,json\n"
+        "t=time.perf_counter()\n"
+        f"import {full_name}\n"
+        "t=time.perf_counter()-t\n"
+        f"heavy=[m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({'time':t,'heavy_modules':heavy}))\n"
+    )
+    #the new interpreters find the package as this one
+    env=dict(os.environ,PYTHONPATH=os.pathsep.join(path for path in sys.path if path!=""))
+
+    times=[]
+    for _ in range(repeat):
+        output=subprocess.run([sys.executable,"-c",code],env=env,capture_output=True,text=True,check=True)
+        result=json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result["time"])
+    result["time"]=min(times)
+    return result
+
+
+def _setup_closest_distance(size,rng):
+    x,y=rng.random(size),rng.random(size)
+    xo,yo=rng.random(10),rng.random(10)
+    from .utils import closest_distance
+    return lambda: closest_distance(x.copy(),y.copy(),xo,yo,3)
+
+
+def _setup_read_parameters_table(size,rng,tmp_dir):
+    #grid of 3 parameters with about size nodes
+    n_axis=max(int(round(size**(1/3))),2)
+    axes=np.meshgrid(np.arange(n_axis),np.arange(n_axis)*0.5,np.arange(n_axis)*2.,indexing="ij")
+    data=np.column_stack([axis.ravel() for axis in axes]+[rng.random(n_axis**3)])
+    path=os.path.join(tmp_dir,f"parameters_{size}.ecsv")
+    with open(path,"w") as file:
+        file.write("# %ECSV 1.0\n# ---\n# datatype:\n")
+        for name in ["x","y","z"]:
+            file.write(f"# - {{name: {name}, datatype: float64}}\n")
+        file.write("# - {name: result, unit: m, datatype: float64}\n# schema: astropy-2.0\n")
+        file.write("x y z result\n")
+        np.savetxt(file,data)
+    from .utils import read_parameters_table
+    return lambda: read_parameters_table(path,1)
+
+
+def _setup_significant_digits(size,rng):
+    values=rng.normal(0,100,size)
+    errors=rng.uniform(0.01,20,size)
+    from .utils import significant_digits
+    def run():
+        for value,error in zip(values,errors):
+            significant_digits(float(value),float(error)).run(1)
+    return run
+
+
+def _setup_run_dataset_lookups(size,rng):
+    dates=np.sort(rng.integers(20200101,20200101+max(size//20,1),size))
+    runs=np.arange(size)
+    from .dataset import run_dataset
+    dataset=run_dataset(runs,dates)
+    query_dates=rng.choice(dates,10)
+    query_runs=rng.choice(runs,10)
+    def run():
+        for date in query_dates:
+            dataset.sort_runs_by_date(date)
+        for run_id in query_runs:
+            dataset.sort_date_by_run(run_id)
+        dataset.number_of_days()
+    return run
+
+
+def _setup_bbox_overlap(size,rng,function):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from . import visualitzation
+    x,y=rng.random(size),rng.random(size)
+    def run():
+        fig,ax=plt.subplots(figsize=(20,20))
+        for i in range(size):
+            ax.text(x[i],y[i],f"S{i}",size=6)
+        getattr(visualitzation,function)(fig,ax)
+        plt.close(fig)
+    return run
+
+
+#name: (setup function, default sizes). The setup function receives the
+#size, a np.random.Generator and a temporary directory, and returns the
+#function to measure.
+BENCHMARKS={
+    "closest_distance":(lambda size,rng,tmp_dir: _setup_closest_distance(size,rng),[100,300,1000]),
+    "read_parameters_table":(_setup_read_parameters_table,[1000,10000,100000,1000000]),
+    "significant_digits":(lambda size,rng,tmp_dir: _setup_significant_digits(size,rng),[1000,10000]),
+    "run_dataset_lookups":(lambda size,rng,tmp_dir: _setup_run_dataset_lookups(size,rng),[1000,10000,100000,1000000]),
+    "avoid_bbox_overlap":(lambda size,rng,tmp_dir: _setup_bbox_overlap(size,rng,"avoid_bbox_overlap"),[10,100,300]),
+    "resolve_bbox_overlap":(lambda size,rng,tmp_dir: _setup_bbox_overlap(size,rng,"resolve_bbox_overlap"),[10,100,1000,5000]),
+}
+
+
+def _measure(func,repeat):
+    """Minimum time of repeat calls and peak memory of one call."""
+    times=[]
+    for _ in range(repeat):
+        start=time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+    
+    tracemalloc.start()
+    try:
+        func()
+        _,peak=tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times),peak
+
+
+def run_benchmarks(names=None,sizes=None,repeat=3,seed=0,verbose=True):
+    """
+    Run the benchmarks with synthetic inputs of several sizes. All the
+    inputs are generated, no file or network access is needed, and
+    the figures use the Agg backend.
+
+    Parameters
+    ----------
+    names: list or None
+        Names of the benchmarks to run (keys of BENCHMARKS). If None, all.
+    sizes: list or None
+        Sizes used for all the benchmarks. If None, the default sizes 
+        of each benchmark.
+    repeat: int
+        Number of times each function is timed. The minimum is kept.
+    seed: int
+        Seed of the random inputs.
+    verbose: bool
+        If True, print each result.
+
+    Returns
+    -------
+    results: dict
+        Dictionary with the environment ("environment") and, for each
+        benchmark and size, the time in seconds and the peak memory 
+        in bytes ("benchmarks").
+    """
+
+    if names==None:
+        names=list(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError(f"Unknown benchmark {name}. Available: {list(BENCHMARKS.keys())}")
+        
+    results={
+        "environment":{
+            "python":platform.python_version(),
+            "numpy":np.__version__,
+            "machine":platform.machine(),
+        },
+        "benchmarks":{},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in names:
+            setup,default_sizes=BENCHMARKS[name]
+            results["benchmarks"][name]={}
+            for size in (default_sizes if sizes==None else sizes):
+                func=setup(size,np.random.default_rng(seed),tmp_dir)
+                elapsed,peak=_measure(func,repeat)
+                results["benchmarks"][name][str(size)]={"time":elapsed,"peak_memory":peak}
+                if verbose:
+                    print(f"{name:<25} {size:>8} {elapsed:10.4f} s {peak/2**20:10.2f} MiB")
+    return results
+
+
+def compare_results(results,baseline,threshold=0.2):
+    """
+    Compare benchmark results with a baseline.
+
+    Parameters
+    ----------
+    results: dict
+        Results of run_benchmarks.
+    baseline: dict
+        Results of run_benchmarks used as reference.
+    threshold: float
+        Maximum fractional increase of time or peak memory allowed.
+
+    Returns
+    -------
+    regressions: list
+        List of (name, size, quantity, baseline value, new value) of the
+        measurements that increased more than threshold. Only the
+        benchmarks and sizes present in both results are compared.
+    """
+
+    regressions=[]
+    for name,sizes in results["benchmarks"].items():
+        for size,values in sizes.items():
+            reference=baseline.get("benchmarks",{}).get(name,{}).get(size)
+            if reference==None:
+                continue
+            for quantity in ["time","peak_memory"]:
+                if values[quantity]>reference[quantity]*(1+threshold):
+                    regressions.append((name,size,quantity,reference[quantity],values[quantity]))
+    return regressions
+
+
+def main(args=None):
+    parser=argparse.ArgumentParser(description="Benchmarks of the hot functions of the package.")
+    parser.add_argument("--names",nargs="+",help="Benchmarks to run: "+", ".join(BENCHMARKS.keys()))
+    parser.add_argument("--sizes",nargs="+",type=int,help="Sizes used for all the benchmarks")
+    parser.add_argument("--repeat",type=int,default=3,help="Number of times each function is timed")
+    parser.add_argument("--output",help="JSON file where the results are written")
+    parser.add_argument("--baseline",help="JSON file with results to compare with")
+    parser.add_argument("--threshold",type=float,default=0.2,help="Maximum fractional regression allowed")
+    args=parser.parse_args(args)
+
+    results=run_benchmarks(args.names,args.sizes,args.repeat)
+    if args.output!=None:
+        with open(args.output,"w") as file:
+            json.dump(results,file,indent=4)
+
+    if args.baseline!=None:
+        with open(args.baseline,"r") as file:
+            baseline=json.load(file)
+        regressions=compare_results(results,baseline,args.threshold)
+        for name,size,quantity,old,new in regressions:
+            print(f"REGRESSION {name} size {size} {quantity}: {old:.4g} -> {new:.4g}")
+        if len(regressions)>0:
+            return 1
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
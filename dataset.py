@@ -1,6 +1,21 @@
 import numpy as np
 from pathlib import Path
+import collections
+import sys
+import threading
 import yaml
+from .instrumentation import count, timed
+
+
+def _result_size(result):
+    """Approximate memory in bytes of a loaded result."""
+    if hasattr(result,"nbytes"):
+        return result.nbytes
+    if isinstance(result,(list,tuple)):
+        return sum(_result_size(item) for item in result)
+    if isinstance(result,dict):
+        return sum(_result_size(item) for item in result.values())
+    return sys.getsizeof(result)
 
 class run_dataset:
     
@@ -47,7 +62,6 @@ class run_dataset:
         >>> dataset=run_dataset(array_runs[:,1],array_runs[:,0])
         """
                     
-        runs=[]
         if initialize_separate_lists:
             array_runs=[]
             for i,dayrun in enumerate(run_id):
@@ -60,8 +74,18 @@ class run_dataset:
 
         self.id=run_id
         self.date=date
-        runs.append(self)
         
+    def freeze(self):
+        """
+        Read-only copy of the dataset, which can be shared between threads.
+        
+        Returns
+        -------
+        dataset: frozen_run_dataset
+        """
+        return frozen_run_dataset(self.id,self.date)
+        
+    @timed("run_dataset.sort_runs_by_date")
     def sort_runs_by_date(self,day):
         """
         Find the runs taken for a specific date.
@@ -89,6 +113,7 @@ class run_dataset:
             list_run_id.append(self.id)     
         return np.array(list_run_id)
     
+    @timed("run_dataset.sort_date_by_run")
     def sort_date_by_run(self,run_id):
         """
         Find the date of a specific run id.
@@ -151,6 +176,119 @@ class run_dataset:
         return np.unique(runs)    
     
     
+    def prefetch(self,loader,n_ahead=4,max_memory=None,group_by_date=False,n_workers=None,sizeof=None):
+        """
+        Iterate over the runs with the result of loader(run_id), while 
+        the following runs are loaded in a pool of threads. This hides
+        the reading time of the inputs behind the processing of the 
+        previous runs.
+        
+        Parameters
+        ----------
+        loader: callable
+            Function that receives a run id and returns its data, e.g.
+            reading the input files of the run.
+        n_ahead: int
+            Maximum number of runs loaded or being loaded ahead of the 
+            one being processed.
+        max_memory: float or None
+            Maximum memory in bytes of the loaded results waiting to be
+            processed. No new run is loaded while it is exceeded, but at
+            least the next run is always loaded. If None, no limit.
+        group_by_date: bool
+            If True, the runs are sorted by date and the results of each
+            date are yielded together.
+        n_workers: int or None
+            Number of threads. If None, n_ahead.
+        sizeof: callable or None
+            Function that returns the memory in bytes of a result. If None,
+            nbytes of the arrays (summed over lists, tuples and dicts) or
+            sys.getsizeof.
+            
+        Returns
+        -------
+        iterator
+            If group_by_date is False, (run_id, result) for each run in 
+            the order of the dataset. If True, (date, list of (run_id, 
+            result)) for each date.
+            
+        Example
+        -------
+        >>> for run_id,events in dataset.prefetch(read_events,n_ahead=8,max_memory=2**30):
+        >>>     process(events)
+        """
+        
+        run_ids=np.atleast_1d(self.id)
+        dates=np.atleast_1d(self.date)
+        if group_by_date:
+            order=np.argsort(dates,kind="stable")
+            run_ids,dates=run_ids[order],dates[order]
+        if sizeof==None:
+            sizeof=_result_size
+        
+        iterator=self._prefetch_runs(loader,run_ids,max(int(n_ahead),1),max_memory,
+                                     n_workers if n_workers!=None else max(int(n_ahead),1),sizeof)
+        if not group_by_date:
+            return iterator
+        return self._group_by_date(iterator,dates)
+    
+    @staticmethod
+    def _prefetch_runs(loader,run_ids,n_ahead,max_memory,n_workers,sizeof):
+        """Generator of (run_id, result) with the next runs loaded in threads."""
+        
+        from concurrent.futures import ThreadPoolExecutor
+        
+        lock=threading.Lock()
+        #memory of the results loaded and not yet yielded
+        held=[0]
+        
+        def load(run_id):
+            result=loader(run_id)
+            size=sizeof(result)
+            with lock:
+                held[0]+=size
+            return result,size
+        
+        pending=collections.deque()
+        next_run=0
+        executor=ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            while next_run<len(run_ids) or len(pending)>0:
+                #start the loading of the next runs within the limits
+                while next_run<len(run_ids) and len(pending)<n_ahead:
+                    with lock:
+                        over_budget=max_memory!=None and held[0]>=max_memory
+                    if over_budget and len(pending)>0:
+                        break
+                    pending.append((run_ids[next_run],executor.submit(load,run_ids[next_run])))
+                    next_run+=1
+                    
+                run_id,future=pending.popleft()
+                result,size=future.result()
+                with lock:
+                    held[0]-=size
+                count("run_dataset.prefetch","runs")
+                yield run_id,result
+                del result
+        finally:
+            for _,future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+    
+    @staticmethod
+    def _group_by_date(iterator,dates):
+        """Generator of (date, list of (run_id, result)) from runs sorted by date."""
+        group=[]
+        for i,(run_id,result) in enumerate(iterator):
+            if len(group)>0 and dates[i]!=dates[i-1]:
+                yield dates[i-1],group
+                group=[]
+            group.append((run_id,result))
+        if len(group)>0:
+            yield dates[len(dates)-1],group
+            
+    
+    @timed("run_dataset.read_dataset")
     def read_dataset(self, file_name):
         """
         Read a dataset from a yaml file.
@@ -196,4 +334,555 @@ class run_dataset:
             dataset_dict[int(date)]=self.sort_runs_by_date(date).tolist()
 
         with open(file_name, 'w') as file:
-            yaml.dump(dataset_dict, file, indent=4, default_flow_style=False)
\ No newline at end of file
+            yaml.dump(dataset_dict, file, indent=4, default_flow_style=False)
+
+def _read_only(array):
+    array=np.asarray(array)
+    if array.flags.writeable:
+        array=array.view()
+        array.flags.writeable=False
+    return array
+
+
+class frozen_run_dataset(run_dataset):
+    
+    def __init__(self,run_id=[],date=[],initialize_separate_lists=False):
+        """
+        Read-only run_dataset: the run ids and dates are stored in 
+        read-only arrays sorted by date (and run id), and the dataset 
+        cannot be modified, so a single instance can be used by many 
+        threads without locks or copies. The queries are binary searches
+        and the selections (by date or range of dates) are views sharing
+        the arrays. Use run_dataset_builder to produce a modified dataset.
+        
+        Parameters
+        ----------
+        run_id : list
+        date : list
+        initialize_separate_lists : bool
+            As in run_dataset.
+        
+        Example
+        -------
+        >>> dataset=run_dataset(array_runs[:,1],array_runs[:,0]).freeze()
+        >>> dataset.sort_runs_by_date(20210904)
+        >>> autumn=dataset.select_dates(20210901,20211130)
+        """
+        
+        dataset=run_dataset(run_id,date,initialize_separate_lists)
+        run_id=np.atleast_1d(np.array(dataset.id))
+        date=np.atleast_1d(np.array(dataset.date))
+        if len(run_id)!=len(date):
+            raise ValueError("Error, run_id and date must have the same length")
+        order=np.lexsort((run_id,date))
+        run_id,date=_read_only(run_id[order]),_read_only(date[order])
+        days,first=np.unique(date,return_index=True)
+        run_order=np.argsort(run_id,kind="stable")
+        self._set_arrays(run_id,date,_read_only(days),_read_only(np.append(first,len(date))),
+                         _read_only(run_order),_read_only(run_id[run_order]),0)
+        
+    def _set_arrays(self,run_id,date,days,day_bounds,run_order,sorted_runs,start):
+        """
+        Store the arrays (sorted by date) and the indexes of the queries.
+        The indexes are the ones of the complete dataset, shared by all 
+        the selections: day_bounds and run_order are positions in the
+        complete dataset, and start is the position of the first run.
+        """
+        object.__setattr__(self,"id",run_id)
+        object.__setattr__(self,"date",date)
+        object.__setattr__(self,"_days",days)
+        object.__setattr__(self,"_day_bounds",day_bounds)
+        object.__setattr__(self,"_run_order",run_order)
+        object.__setattr__(self,"_sorted_runs",sorted_runs)
+        object.__setattr__(self,"_start",start)
+        
+    def __reduce__(self):
+        #rebuilt with read-only arrays by pickle and copy
+        return (frozen_run_dataset,(np.array(self.id),np.array(self.date)))
+        
+    def __setattr__(self,name,value):
+        raise AttributeError("frozen_run_dataset cannot be modified, use run_dataset_builder")
+        
+    def __delattr__(self,name):
+        raise AttributeError("frozen_run_dataset cannot be modified, use run_dataset_builder")
+        
+    def _view(self,first_day,stop_day):
+        """
+        Dataset with the runs of the days first_day:stop_day, sharing the
+        arrays and the indexes.
+        """
+        start=self._day_bounds[first_day]
+        stop=self._day_bounds[stop_day]
+        view=object.__new__(frozen_run_dataset)
+        view._set_arrays(self.id[start-self._start:stop-self._start],
+                         self.date[start-self._start:stop-self._start],
+                         self._days[first_day:stop_day],self._day_bounds[first_day:stop_day+1],
+                         self._run_order,self._sorted_runs,start)
+        return view
+    
+    def sort_runs_by_date(self,day):
+        """
+        Find the runs taken for a specific date.
+        
+        Parameters
+        ----------
+        day: int
+            Date of interest. Format: YYYYMMDD.
+
+        Returns
+        -------
+        list_run_id: np.array
+            Read-only view with the run ids that were taken the date "day".
+        """
+        start=np.searchsorted(self.date,day,side="left")
+        stop=np.searchsorted(self.date,day,side="right")
+        return self.id[start:stop]
+    
+    def sort_date_by_run(self,run_id):
+        """
+        Find the date of a specific run id.
+        
+        Parameters
+        ----------
+        run_id: int
+            Run id of interest.
+            
+        Returns
+        -------
+        date: int or None
+            Date for which run_id was taken. None if the run is not in
+            the dataset.
+        """
+        first=np.searchsorted(self._sorted_runs,run_id,side="left")
+        stop=np.searchsorted(self._sorted_runs,run_id,side="right")
+        #the index is the one of the complete dataset
+        for position in self._run_order[first:stop]:
+            if self._start<=position<self._start+len(self.id):
+                return self.date[position-self._start]
+        return None
+    
+    def number_of_days(self):
+        """
+        Obtain the total number of days.
+        
+        Returns
+        -------
+        days: np.array
+            Read-only array with the days.
+        """
+        return self._days
+    
+    def number_of_runs(self):
+        """
+        Obtain the total number of run ids.
+        
+        Returns
+        -------
+        runs: np.array
+            List of run ids.
+        """
+        return np.unique(self.id)
+    
+    def select_date(self,day):
+        """
+        Runs of a date, as a frozen_run_dataset sharing the arrays.
+        
+        Parameters
+        ----------
+        day: int
+            Date of interest. Format: YYYYMMDD.
+            
+        Returns
+        -------
+        dataset: frozen_run_dataset
+        """
+        return self.select_dates(day,day)
+    
+    def select_dates(self,start,end):
+        """
+        Runs taken between two dates (both included), as a 
+        frozen_run_dataset sharing the arrays.
+        
+        Parameters
+        ----------
+        start: int
+            First date. Format: YYYYMMDD.
+        end: int
+            Last date. Format: YYYYMMDD.
+            
+        Returns
+        -------
+        dataset: frozen_run_dataset
+        """
+        return self._view(np.searchsorted(self._days,start,side="left"),
+                          np.searchsorted(self._days,end,side="right"))
+    
+    def freeze(self):
+        """The dataset is already read-only."""
+        return self
+    
+    def read_dataset(self,file_name):
+        raise AttributeError("frozen_run_dataset cannot be modified, use run_dataset_builder")
+    
+    def write_dataset(self,file_name):
+        """
+        Write to yaml file the dataset, as run_dataset.write_dataset.
+        
+        Parameters        
+        ----------
+        file_name: str
+        Path and file name of the yaml file with the dataset
+        
+        """
+        dataset_dict={}
+        for iday,day in enumerate(self._days):
+            runs=self.id[self._day_bounds[iday]-self._start:self._day_bounds[iday+1]-self._start]
+            dataset_dict[int(day)]=runs.tolist()
+            
+        with open(file_name, 'w') as file:
+            yaml.dump(dataset_dict, file, indent=4, default_flow_style=False)
+            
+            
+class run_dataset_builder:
+    
+    def __init__(self,dataset=None):
+        """
+        Collect runs to produce a frozen_run_dataset.
+        
+        Parameters
+        ----------
+        dataset: run_dataset or None
+            Dataset with the initial runs, e.g. to add runs to a 
+            frozen_run_dataset.
+            
+        Example
+        -------
+        >>> builder=run_dataset_builder(dataset)
+        >>> builder.add_runs([6071,6072],20210906)
+        >>> dataset=builder.build()
+        """
+        self._run_id=[]
+        self._date=[]
+        if dataset!=None:
+            self._run_id.append(np.atleast_1d(np.array(dataset.id)))
+            self._date.append(np.atleast_1d(np.array(dataset.date)))
+            
+    def add_runs(self,run_id,date):
+        """
+        Add runs.
+        
+        Parameters
+        ----------
+        run_id: list
+            Run ids.
+        date: list or int
+            Date of each run, or a single date for all of them. Format: YYYYMMDD.
+        """
+        run_id=np.atleast_1d(np.array(run_id))
+        date=np.broadcast_to(np.array(date),run_id.shape)
+        self._run_id.append(run_id)
+        self._date.append(np.array(date))
+        return self
+    
+    def remove_runs(self,run_id):
+        """
+        Remove runs.
+        
+        Parameters
+        ----------
+        run_id: list
+            Run ids to remove.
+        """
+        run_ids,dates=self._arrays()
+        keep=~np.isin(run_ids,run_id)
+        self._run_id,self._date=[run_ids[keep]],[dates[keep]]
+        return self
+    
+    def read_dataset(self,file_name):
+        """
+        Add the runs of a yaml file (written by run_dataset.write_dataset).
+        
+        Parameters        
+        ----------
+        file_name: str
+        Path and file name of the yaml file with the dataset
+        
+        """
+        dataset=run_dataset()
+        dataset.read_dataset(file_name)
+        self._run_id.append(np.atleast_1d(np.array(dataset.id)))
+        self._date.append(np.atleast_1d(np.array(dataset.date)))
+        return self
+    
+    def _arrays(self):
+        if len(self._run_id)==0:
+            return np.array([],dtype=np.int64),np.array([],dtype=np.int64)
+        return np.concatenate(self._run_id),np.concatenate(self._date)
+    
+    def build(self):
+        """
+        Returns
+        -------
+        dataset: frozen_run_dataset
+            Dataset with the runs added.
+        """
+        return frozen_run_dataset(*self._arrays())
+
+
+class run_catalogue:
+    
+    def __init__(self,file_name):
+        """
+        Catalogue of runs stored in a SQLite file, with indexes on the run
+        id and the date. The queries are answered from the file without
+        loading the whole catalogue, as an alternative to run_dataset for
+        very large catalogues.
+        
+        Parameters
+        ----------
+        file_name: str
+            Path and file name of the SQLite file. It is created if it
+            does not exist.
+            
+        Example
+        -------
+        >>> with run_catalogue("runs.sqlite") as catalogue:
+        >>>     catalogue.read_dataset("dataset.yaml")
+        >>>     catalogue.sort_runs_by_date(20210904)
+        """
+        
+        import sqlite3
+        
+        self.file_name=str(file_name)
+        self._connection=sqlite3.connect(self.file_name)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs "
+                "(run_id INTEGER PRIMARY KEY, date INTEGER NOT NULL, metadata TEXT)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS runs_date ON runs (date, run_id)")
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+        
+    def close(self):
+        """Close the SQLite file."""
+        self._connection.close()
+        
+    def add_runs(self,run_id,date,metadata=None):
+        """
+        Add runs to the catalogue in a single transaction. Runs already 
+        in the catalogue are updated: their date is replaced, and their 
+        metadata only if new metadata is given.
+        
+        Parameters
+        ----------
+        run_id: list
+            Run ids.
+        date: list
+            Date of each run. Format: YYYYMMDD.
+        metadata: list or None
+            Dict with the metadata of each run (None to keep the stored
+            one), stored as JSON.
+        """
+        
+        import json
+        
+        run_id=np.atleast_1d(run_id)
+        date=np.atleast_1d(date)
+        if len(run_id)!=len(date):
+            raise ValueError("Error, run_id and date must have the same length")
+        if metadata==None:
+            metadata=[None]*len(run_id)
+        elif len(metadata)!=len(run_id):
+            raise ValueError("Error, metadata must have the same length as run_id")
+        
+        rows=((int(run),int(day),None if meta==None else json.dumps(meta))
+              for run,day,meta in zip(run_id,date,metadata))
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO runs VALUES (?,?,?) ON CONFLICT(run_id) DO UPDATE SET "
+                "date=excluded.date, metadata=COALESCE(excluded.metadata,runs.metadata)",rows
+            )
+        count("run_catalogue.add_runs","runs",len(run_id))
+            
+    def sort_runs_by_date(self,day):
+        """
+        Find the runs taken for a specific date.
+        
+        Parameters
+        ----------
+        day: int
+            Date of interest. Format: YYYYMMDD.
+
+        Returns
+        -------
+        list_run_id: np.array
+            List of run ids that were taken the date "day".
+        """
+        
+        rows=self._connection.execute("SELECT run_id FROM runs WHERE date=? ORDER BY run_id",(int(day),))
+        return np.array([row[0] for row in rows],dtype=np.int64)
+    
+    def sort_date_by_run(self,run_id):
+        """
+        Find the date of a specific run id.
+        
+        Parameters
+        ----------
+        run_id: int
+            Run id of interest.
+            
+        Returns
+        -------
+        date: int or None
+            Date for which run_id was taken. None if the run is not in
+            the catalogue.
+        """
+        
+        row=self._connection.execute("SELECT date FROM runs WHERE run_id=?",(int(run_id),)).fetchone()
+        return None if row==None else row[0]
+    
+    def runs_in_date_range(self,start,end):
+        """
+        Find the runs taken between two dates, both included.
+        
+        Parameters
+        ----------
+        start: int
+            First date. Format: YYYYMMDD.
+        end: int
+            Last date. Format: YYYYMMDD.
+            
+        Returns
+        -------
+        list_run_id: np.array
+            List of run ids, sorted by date and run id.
+        dates: np.array
+            Date of each run.
+        """
+        
+        rows=self._connection.execute(
+            "SELECT run_id, date FROM runs WHERE date BETWEEN ? AND ? ORDER BY date, run_id",
+            (int(start),int(end))
+        ).fetchall()
+        data=np.array(rows,dtype=np.int64).reshape(-1,2)
+        return data[:,0],data[:,1]
+    
+    def metadata(self,run_id):
+        """
+        Metadata of a run.
+        
+        Parameters
+        ----------
+        run_id: int
+            Run id of interest.
+            
+        Returns
+        -------
+        metadata: dict or None
+            Metadata of the run. None if it has no metadata or the run is
+            not in the catalogue (as sort_date_by_run).
+        """
+        
+        import json
+        
+        row=self._connection.execute("SELECT metadata FROM runs WHERE run_id=?",(int(run_id),)).fetchone()
+        if row==None or row[0]==None:
+            return None
+        return json.loads(row[0])
+    
+    def number_of_days(self):
+        """
+        Obtain the total number of days.
+        
+        Returns
+        -------
+        days: np.array
+            List of days.
+        """
+        
+        rows=self._connection.execute("SELECT DISTINCT date FROM runs ORDER BY date")
+        return np.array([row[0] for row in rows],dtype=np.int64)
+    
+    def number_of_runs(self):
+        """
+        Obtain the total number of run ids.
+        
+        Returns
+        -------
+        runs: np.array
+            List of run ids.
+        """
+        
+        rows=self._connection.execute("SELECT run_id FROM runs ORDER BY run_id")
+        return np.array([row[0] for row in rows],dtype=np.int64)
+    
+    def to_run_dataset(self,start=None,end=None):
+        """
+        Load the runs, or the runs between two dates, in a run_dataset.
+        
+        Parameters
+        ----------
+        start: int or None
+            First date. If None, from the first date of the catalogue.
+        end: int or None
+            Last date. If None, until the last date of the catalogue.
+            
+        Returns
+        -------
+        dataset: run_dataset
+        """
+        
+        run_id,date=self.runs_in_date_range(-2**62 if start==None else start,2**62 if end==None else end)
+        return run_dataset(run_id,date)
+    
+    @timed("run_catalogue.read_dataset")
+    def read_dataset(self,file_name):
+        """
+        Add the runs of a yaml file (written by run_dataset.write_dataset)
+        to the catalogue in a single transaction. The date of the runs
+        already in the catalogue is updated and their metadata is kept.
+        
+        Parameters        
+        ----------
+        file_name: str
+        Path and file name of the yaml file with the dataset
+        
+        """
+        
+        if not Path(file_name).exists():
+            raise FileNotFoundError(f"File {file_name} does not exist")
+
+        with open(file_name, 'r') as file:
+            data = yaml.load(file, Loader=getattr(yaml,"CSafeLoader",yaml.SafeLoader))
+
+        rows=((int(run),int(day)) for day,runs in data.items() for run in np.atleast_1d(runs))
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO runs VALUES (?,?,NULL) ON CONFLICT(run_id) DO UPDATE SET date=excluded.date",rows
+            )
+    
+    @timed("run_catalogue.write_dataset")
+    def write_dataset(self,file_name):
+        """
+        Write to yaml file the catalogue, with the same format as 
+        run_dataset.write_dataset. 
+        
+        Parameters        
+        ----------
+        file_name: str
+        Path and file name of the yaml file with the dataset
+        
+        """
+        
+        dataset_dict={}
+        for run,day in self._connection.execute("SELECT run_id, date FROM runs ORDER BY date, run_id"):
+            dataset_dict.setdefault(day,[]).append(run)
+
+        with open(file_name, 'w') as file:
+            yaml.dump(dataset_dict, file, indent=4, default_flow_style=False, 
+                      Dumper=getattr(yaml,"CSafeDumper",yaml.SafeDumper))
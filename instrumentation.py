@@ -0,0 +1,138 @@
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+
+__all__=[
+    "count",
+    "get_stats",
+    "instrument",
+    "is_enabled",
+    "log",
+    "reset_stats",
+    "timed",
+]
+
+#the diagnostics are sent to the logger of the package with level DEBUG
+logger=logging.getLogger(__name__.rpartition(".")[0] or __name__)
+
+#disabled unless the environment variable is set to a true value
+_ENABLED=os.environ.get("ARNAUPY_INSTRUMENT","").lower() in ["1","true","yes","on"]
+_STATS={}
+_LOCK=threading.Lock()
+
+
+def is_enabled():
+    """Whether the instrumentation is enabled."""
+    return _ENABLED
+
+
+@contextlib.contextmanager
+def instrument(reset=False):
+    """
+    Enable the instrumentation inside the with statement.
+
+    Parameters
+    ----------
+    reset: bool
+        If True, remove the previous statistics first.
+
+    Example
+    -------
+    >>> with instrument():
+    >>>     read_parameters_table(path,1)
+    >>> get_stats()["read_parameters_table"]["time"]
+    """
+    global _ENABLED
+    if reset:
+        reset_stats()
+    previous=_ENABLED
+    _ENABLED=True
+    try:
+        yield
+    finally:
+        _ENABLED=previous
+
+
+def _entry(name):
+    """Statistics of name, created if needed. Call it with _LOCK held."""
+    if name not in _STATS:
+        _STATS[name]={"calls":0,"time":0.,"max_time":0.}
+    return _STATS[name]
+
+
+def timed(name=None):
+    """
+    Decorator that counts the calls and measures the time of a function
+    when the instrumentation is enabled.
+
+    Parameters
+    ----------
+    name: str or None
+        Name in the statistics. If None, the qualified name of the function.
+    """
+    def decorator(func):
+        key=func.__qualname__ if name==None else name
+
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not _ENABLED:
+                return func(*args,**kwargs)
+            start=time.perf_counter()
+            try:
+                return func(*args,**kwargs)
+            finally:
+                elapsed=time.perf_counter()-start
+                with _LOCK:
+                    entry=_entry(key)
+                    entry["calls"]+=1
+                    entry["time"]+=elapsed
+                    entry["max_time"]=max(entry["max_time"],elapsed)
+                logger.debug("%s took %.6f s",key,elapsed)
+        return wrapper
+    return decorator
+
+
+def count(name,counter,value=1):
+    """
+    Add value to a counter (e.g. number of rows or texts) of name when
+    the instrumentation is enabled.
+    """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        entry=_entry(name)
+        entry[counter]=entry.get(counter,0)+value
+
+
+def log(name,message,*args):
+    """
+    Send a diagnostic message of name to the logger (level DEBUG) when
+    the instrumentation is enabled. The message is formatted with args
+    only if it is sent.
+    """
+    if _ENABLED:
+        logger.debug("%s: "+message,name,*args)
+
+
+def get_stats():
+    """
+    Statistics recorded since the last reset.
+
+    Returns
+    -------
+    stats: dict
+        Dictionary with, for each name, the number of calls ("calls"),
+        the total and maximum time in seconds ("time", "max_time") and
+        the counters.
+    """
+    with _LOCK:
+        return {name:dict(entry) for name,entry in _STATS.items()}
+
+
+def reset_stats():
+    """Remove all the recorded statistics."""
+    with _LOCK:
+        _STATS.clear()
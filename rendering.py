@@ -0,0 +1,120 @@
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+__all__=[
+    "render_figures",
+]
+
+
+def _init_worker(use_2cool_style,rcParams):
+    """
+    Prepare a worker process: Agg backend and rcParams, set once for
+    all the figures rendered by the worker.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+
+    if use_2cool_style:
+        from .visualitzation import update_2cool_rcParams
+        update_2cool_rcParams(**rcParams)
+    else:
+        matplotlib.rcParams.update(rcParams)
+
+
+def _render_job(plot_func,job,file_name,savefig_kwargs):
+    """
+    Produce the figure of a job and write it to file_name.
+
+    Returns
+    -------
+    ok: bool
+        Whether the figure has been written.
+    result: str
+        File name, or the traceback if there has been an error.
+    """
+    import matplotlib.pyplot as plt
+
+    try:
+        fig=plot_func(job)
+        try:
+            Path(file_name).parent.mkdir(parents=True,exist_ok=True)
+            fig.savefig(file_name,**savefig_kwargs)
+        finally:
+            plt.close(fig)
+    except Exception:
+        return False,traceback.format_exc()
+    return True,file_name
+
+
+def render_figures(plot_func,jobs,file_name,n_workers=None,use_2cool_style=True,rcParams={},
+                   savefig_kwargs={},verbose=True):
+    """
+    Produce many figures in parallel in a pool of processes with the
+    Agg backend. Each figure is written to disk as soon as it is done.
+
+    Parameters
+    ----------
+    plot_func: callable
+        Function that receives a job and returns the matplotlib figure.
+        It must be defined at module level so it can be sent to the
+        worker processes.
+    jobs: iterable
+        Jobs to plot, for example the run ids of a run_dataset
+        (run_dataset.number_of_runs()).
+    file_name: str or callable
+        Output file of each job. If str, it is formatted with the job,
+        e.g. "figures/run_{job}.png". If callable, it receives the job
+        and returns the file name.
+    n_workers: int or None
+        Number of processes. If None, the number of CPUs.
+    use_2cool_style: bool
+        If True, update_2cool_rcParams(**rcParams) is applied once in
+        each worker. Else, only rcParams are applied.
+    rcParams: dict
+        rcParams applied in each worker.
+    savefig_kwargs: dict
+        Kwargs passed to savefig.
+    verbose: bool
+        If True, print the progress and the errors.
+
+    Returns
+    -------
+    done: list
+        List of (job, file name) of the written figures.
+    failed: list
+        List of (job, traceback) of the jobs that raised an error.
+    """
+
+    jobs=list(jobs)
+    if isinstance(file_name,str):
+        template=file_name
+        file_names=[template.format(job=job) for job in jobs]
+    else:
+        file_names=[str(file_name(job)) for job in jobs]
+
+    done,failed=[],[]
+    with ProcessPoolExecutor(max_workers=n_workers,initializer=_init_worker,
+                             initargs=(use_2cool_style,rcParams)) as pool:
+        futures={pool.submit(_render_job,plot_func,job,name,savefig_kwargs):job
+                 for job,name in zip(jobs,file_names)}
+        for future in as_completed(futures):
+            job=futures[future]
+            try:
+                ok,result=future.result()
+            except Exception:
+                #the worker died or the job could not be sent to it
+                ok,result=False,traceback.format_exc()
+            if ok:
+                done.append((job,result))
+            else:
+                failed.append((job,result))
+
+            if verbose:
+                n=len(done)+len(failed)
+                if ok:
+                    print(f"[{n}/{len(jobs)}] {result}")
+                else:
+                    print(f"[{n}/{len(jobs)}] job {job} failed:\n{result}")
+
+    return done,failed
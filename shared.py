@@ -0,0 +1,328 @@
+import contextlib
+import multiprocessing
+import os
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+
+from .instrumentation import count, log
+
+__all__=[
+    "get_shared",
+    "shared_array",
+    "shared_arrays",
+    "shared_pool",
+]
+
+#arrays attached by this process, kept until the shared_arrays that published
+#them is closed (in the workers, while the process lives)
+_ATTACHED={}
+#objects published by shared_pool, attached in each worker
+_WORKER_SHARED={}
+
+
+def _attach_segment(name,owner_pid):
+    """
+    Attach a shared memory segment without taking its ownership. Before
+    Python 3.13 attaching also registers the segment in the resource
+    tracker, and the tracker of a process that is not the owner or one
+    of its children (which share the tracker of the owner) would unlink
+    the segment when the process exits, so it is unregistered.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name,track=False)
+    except TypeError:
+        segment=shared_memory.SharedMemory(name=name)
+        parent=multiprocessing.parent_process()
+        if os.getpid()!=owner_pid and (parent==None or parent.pid!=owner_pid):
+            resource_tracker.unregister(segment._name,"shared_memory")
+        return segment
+
+
+class shared_array:
+    """
+    Handle of an array published by shared_arrays. It is small and cheap
+    to pickle, and attach gives the array in any process without copying
+    it.
+    """
+
+    def __init__(self,shape,dtype,unit=None,segment_name=None,path=None,owner_pid=None):
+        self.shape=tuple(shape)
+        self.dtype=np.dtype(dtype).str
+        self.unit=unit
+        self.segment_name=segment_name
+        self.path=path
+        self.owner_pid=owner_pid
+
+    def attach(self):
+        """
+        Get the array, read-only. Astropy quantities are returned with
+        their unit.
+
+        Returns
+        -------
+        array: np.array
+        """
+        key=self.segment_name if self.segment_name!=None else self.path
+        if key not in _ATTACHED:
+            if self.segment_name!=None:
+                segment=_attach_segment(self.segment_name,self.owner_pid)
+                array=np.ndarray(self.shape,dtype=self.dtype,buffer=segment.buf)
+            else:
+                segment=None
+                array=np.load(self.path,mmap_mode="r")
+            array.flags.writeable=False
+            _ATTACHED[key]=(segment,array)
+            count("shared_array.attach","arrays")
+        array=_ATTACHED[key][1]
+
+        if self.unit!=None:
+            import astropy.units as u
+            return u.Quantity(array,self.unit,copy=False)
+        return array
+
+
+class _shared_run_dataset:
+    """Handle of a run_dataset published by shared_arrays."""
+
+    def __init__(self,run_id,date):
+        self.run_id=run_id
+        self.date=date
+
+    def attach(self):
+        from .dataset import run_dataset
+        return run_dataset(self.run_id.attach(),self.date.attach())
+
+
+def _attach_all(handles):
+    """Replace the handles of a structure published by shared_arrays.publish_all."""
+    if isinstance(handles,(shared_array,_shared_run_dataset)):
+        return handles.attach()
+    if isinstance(handles,dict):
+        return {key:_attach_all(value) for key,value in handles.items()}
+    if isinstance(handles,(list,tuple)):
+        return type(handles)(_attach_all(value) for value in handles)
+    return handles
+
+
+class shared_arrays:
+    """
+    Arrays published in shared memory (multiprocessing.shared_memory) or
+    in files mapped in memory (np.memmap), so many processes can read
+    them without each receiving a pickled copy. The handles returned by
+    publish are sent to the processes instead of the arrays.
+
+    The segments and files are removed by close, or at the end of the
+    with statement: they must not be used afterwards.
+
+    Example
+    -------
+    >>> with shared_arrays() as shared:
+    >>>     handle=shared.publish(grid)
+    >>>     pool.submit(process_chunk,handle,chunk)
+    >>> #in the worker
+    >>> def process_chunk(handle,chunk):
+    >>>     grid=handle.attach()
+    """
+
+    def __init__(self,use_memmap=False,tmp_dir=None):
+        """
+        Parameters
+        ----------
+        use_memmap: bool
+            If True, the arrays are written to files mapped in memory.
+            Else, shared memory is used.
+        tmp_dir: str or None
+            Directory of the files with use_memmap. If None, a temporary
+            directory.
+        """
+        self.use_memmap=use_memmap
+        self._segments=[]
+        self._tmp_dir=None
+        if use_memmap:
+            if tmp_dir==None:
+                self._tmp_dir=tempfile.TemporaryDirectory()
+                tmp_dir=self._tmp_dir.name
+            self.tmp_dir=Path(tmp_dir)
+        self._paths=[]
+
+    def publish(self,array):
+        """
+        Copy an array to shared memory (or a mapped file).
+
+        Parameters
+        ----------
+        array: np.array or astropy.units.Quantity
+            Array to publish. Object arrays cannot be published.
+
+        Returns
+        -------
+        handle: shared_array
+        """
+        unit=None
+        if hasattr(array,"unit") and hasattr(array,"value"):
+            unit=array.unit.to_string()
+            array=array.value
+        array=np.asarray(array)
+        if array.dtype.hasobject:
+            raise ValueError("Error, arrays of python objects cannot be shared")
+
+        count("shared_arrays.publish","bytes",array.nbytes)
+        if self.use_memmap:
+            path=str(self.tmp_dir/f"shared_{uuid.uuid4().hex}.npy")
+            mapped=np.lib.format.open_memmap(path,mode="w+",dtype=array.dtype,shape=array.shape)
+            mapped[...]=array
+            mapped.flush()
+            del mapped
+            self._paths.append(path)
+            return shared_array(array.shape,array.dtype,unit,path=path)
+
+        segment=shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+        self._segments.append(segment)
+        np.ndarray(array.shape,dtype=array.dtype,buffer=segment.buf)[...]=array
+        return shared_array(array.shape,array.dtype,unit,segment_name=segment.name,owner_pid=os.getpid())
+
+    def publish_all(self,obj):
+        """
+        Publish all the arrays of a structure: dicts, lists and tuples are
+        traversed, arrays (and lists of numbers) are published and run_dataset
+        objects are published with their run ids and dates. Other values
+        are kept, and sent pickled.
+
+        Parameters
+        ----------
+        obj: dict, list, tuple, np.array or run_dataset
+            For example {"dataset": dataset, "grid": read_parameters_table(path,2)}.
+
+        Returns
+        -------
+        handles:
+            Same structure with the handles. Use attach_all (or get_shared
+            in the workers of shared_pool) to get the arrays.
+        """
+        from .dataset import run_dataset
+
+        if isinstance(obj,run_dataset):
+            return _shared_run_dataset(self.publish(np.asarray(obj.id)),self.publish(np.asarray(obj.date)))
+        if isinstance(obj,np.ndarray) or (hasattr(obj,"unit") and hasattr(obj,"value")):
+            return self.publish(obj)
+        if isinstance(obj,dict):
+            return {key:self.publish_all(value) for key,value in obj.items()}
+        if isinstance(obj,(list,tuple)):
+            if len(obj)>0 and all(isinstance(value,(int,float,np.number)) for value in obj):
+                return self.publish(np.asarray(obj))
+            return type(obj)(self.publish_all(value) for value in obj)
+        return obj
+
+    @staticmethod
+    def attach_all(handles):
+        """
+        Get the arrays of a structure returned by publish_all.
+        """
+        return _attach_all(handles)
+
+    def close(self):
+        """Remove the shared memory segments and the files."""
+        #forget the arrays attached in this process
+        for key in [segment.name for segment in self._segments]+self._paths:
+            attached,_=_ATTACHED.pop(key,(None,None))
+            if attached!=None:
+                try:
+                    attached.close()
+                except BufferError:
+                    #still used, unmapped when the arrays are deleted
+                    log("shared_arrays","segment %s still in use",key)
+        for segment in self._segments:
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                log("shared_arrays","segment %s already removed",segment.name)
+        self._segments=[]
+        for path in self._paths:
+            #on some systems the file cannot be removed while it is mapped
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self._paths=[]
+        if self._tmp_dir!=None:
+            with contextlib.suppress(OSError):
+                self._tmp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,exc_traceback):
+        self.close()
+
+
+def _init_shared_worker(handles,initializer,initargs):
+    """Attach the published objects once in each worker of shared_pool."""
+    _WORKER_SHARED.clear()
+    _WORKER_SHARED.update(_attach_all(handles))
+    if initializer!=None:
+        initializer(*initargs)
+
+
+def get_shared(name):
+    """
+    Get an object published by shared_pool, in one of its workers.
+
+    Parameters
+    ----------
+    name: str
+        Key of the object in the dict given to shared_pool.
+    """
+    if name not in _WORKER_SHARED:
+        raise ValueError(f"Error, {name} is not shared with this process")
+    return _WORKER_SHARED[name]
+
+
+@contextlib.contextmanager
+def shared_pool(objects,n_workers=None,use_memmap=False,tmp_dir=None,initializer=None,initargs=()):
+    """
+    Pool of processes where the arrays of objects are shared without
+    copying. The objects are published once with shared_arrays.publish_all
+    and attached read-only in each worker when it starts; the jobs get
+    them with get_shared. The shared memory is removed when the pool
+    exits.
+
+    Parameters
+    ----------
+    objects: dict
+        Objects to share, by name (arrays, run_dataset, results of
+        read_parameters_table...).
+    n_workers: int or None
+        Number of processes. If None, the number of CPUs.
+    use_memmap: bool
+        If True, use files mapped in memory instead of shared memory.
+    tmp_dir: str or None
+        Directory of the files with use_memmap.
+    initializer: callable or None
+        Additional initializer of the workers, called after attaching.
+    initargs: tuple
+        Arguments of initializer.
+
+    Returns
+    -------
+    pool: concurrent.futures.ProcessPoolExecutor
+
+    Example
+    -------
+    >>> def closest_nodes(i):
+    >>>     x,y=get_shared("x"),get_shared("y")
+    >>>     return closest_distance(x.copy(),y.copy(),xo[i],yo[i],3)
+    >>> with shared_pool({"x":x,"y":y}) as pool:
+    >>>     results=list(pool.map(closest_nodes,range(len(xo))))
+    """
+    if not isinstance(objects,dict):
+        raise ValueError("Error, objects must be a dict with the name of each object")
+
+    with shared_arrays(use_memmap,tmp_dir) as shared:
+        handles=shared.publish_all(objects)
+        with ProcessPoolExecutor(max_workers=n_workers,initializer=_init_shared_worker,
+                                 initargs=(handles,initializer,initargs)) as pool:
+            yield pool
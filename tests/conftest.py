@@ -0,0 +1,10 @@
+import sys
+import types
+from pathlib import Path
+
+#the modules of the repository form the package arnaupy, which is not
+#installed: register the repository directory as the package
+if "arnaupy" not in sys.modules:
+    package=types.ModuleType("arnaupy")
+    package.__path__=[str(Path(__file__).resolve().parent.parent)]
+    sys.modules["arnaupy"]=package
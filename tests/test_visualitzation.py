@@ -0,0 +1,24 @@
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+from arnaupy.visualitzation import insert_labels, measure_text_extents
+
+
+def test_insert_labels_empty_axes():
+    #the first label of an axes without texts, one label per call
+    fig,ax=plt.subplots()
+    txts=[]
+    for i in range(5):
+        txt=ax.text(0.5,0.5,f"S{i}")
+        insert_labels(fig,ax,[txt])
+        txts.append(txt)
+        
+    extents=measure_text_extents(fig,txts)
+    for i in range(len(txts)):
+        for j in range(i+1,len(txts)):
+            width=min(extents[i,2],extents[j,2])-max(extents[i,0],extents[j,0])
+            height=min(extents[i,3],extents[j,3])-max(extents[i,1],extents[j,1])
+            assert width<=0 or height<=0 or width*height<=0.1*np.prod(extents[i,2:]-extents[i,:2])
+    plt.close(fig)
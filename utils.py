@@ -1,12 +1,25 @@
 import numpy as np
+import hashlib
 import math
-from astropy.table import Table
+import io
+import itertools
+import os
+import tempfile
+from pathlib import Path
+from .instrumentation import count, log, timed
 
 __all__=[
+    "build_axes_index",
     "closest_distance",
+    "format_significant_digits",
+    "grid_interpolator",
     "normalization",
+    "parameters_index",
     "read_parameters_table",
+    "read_parameters_table_chunked",
+    "read_parameters_tables",
     "significant_digits",
+    "write_results_table",
 ]
 
 class significant_digits:
@@ -209,6 +222,7 @@ class significant_digits:
         
         return val
             
+    @timed("significant_digits.run")
     def run(self,precision=1):
         """
         Run the script to round the value (and its uncertainty)
@@ -277,7 +291,7 @@ class significant_digits:
                     self.value*10**(-self.n_zero_decimals),
                     10
                 )
-                print(first_two_significant_value_figures)
+                log("significant_digits.run","first two significant figures %s",first_two_significant_value_figures)
                 #first significant digit is 1
                 if int(first_two_significant_value_figures)==1:
                     self.value = self.rounding_of_one(
@@ -288,32 +302,93 @@ class significant_digits:
                         self.value, first_two_significant_value_figures
                     )
             else:
-                print("No rounding because the value is > 10")
+                log("significant_digits.run","no rounding because the value is > 10")
                 
         return self.value, self.error_value
 
 
-def normalization(x):
+@timed()
+def normalization(x,axis=None,out=None,chunk_size=None,ignore_nan=False):
     """
     Normalize between 0 and 1 an array.
     
+    The input is not copied, so np.memmap arrays larger than the memory
+    can be normalized using chunk_size: the minimum and maximum are found
+    chunk by chunk and then each chunk is rescaled and written to out.
+    
     Parameters
     ----------
     x: np.array
         Array to normalize between 0 and 1.
+    axis: int or None
+        Axis along which the minimum and maximum are computed. If None,
+        the whole array is used.
+    out: np.array or None
+        Array where the result is written, with the same shape as x. It
+        can be x itself (if it is a float array) to normalize in place,
+        or a np.memmap. If None, a new array is created.
+    chunk_size: int or None
+        Number of elements along the first dimension processed at once.
+        If None, the whole array is processed at once.
+    ignore_nan: bool
+        If True, NaN values are ignored to compute the minimum and maximum.
 
     Returns
     -------
     norm_x: np.array
-        Normalized array.
+        Normalized array. Where the maximum is equal to the minimum,
+        the normalized value is 0.
     """
     
-    x = np.array(x)
-    norm_x = (x - np.min(x)) / (np.max(x) - np.min(x))
+    x = np.asanyarray(x)
+    if axis!=None:
+        axis=axis%x.ndim
+    if out is None:
+        out=np.empty(x.shape,dtype=np.result_type(x.dtype,np.float64))
+    elif out.shape!=x.shape:
+        raise ValueError(f"out has shape {out.shape} but x has shape {x.shape}")
+    
+    if x.ndim==0:
+        chunks=[Ellipsis]
+    else:
+        if chunk_size==None:
+            chunk_size=max(x.shape[0],1)
+        chunks=[slice(i,i+chunk_size) for i in range(0,x.shape[0],chunk_size)]
+    
+    minimum=np.nanmin if ignore_nan else np.min
+    maximum=np.nanmax if ignore_nan else np.max
+    
+    #first pass: minimum and maximum chunk by chunk
+    min_x,max_x=[],[]
+    for chunk in chunks:
+        min_x.append(minimum(x[chunk],axis=axis,keepdims=axis!=None))
+        max_x.append(maximum(x[chunk],axis=axis,keepdims=axis!=None))
+    if axis==None or axis==0:
+        min_x=minimum(min_x,axis=0)
+        max_x=maximum(max_x,axis=0)
+    else:
+        min_x=np.concatenate(min_x,axis=0)
+        max_x=np.concatenate(max_x,axis=0)
+    
+    range_x=max_x-min_x
+    range_x=np.where(range_x==0,1,range_x)
+
+    #second pass: rescale each chunk
+    for chunk in chunks:
+        if axis==None or axis==0:
+            chunk_min,chunk_range=min_x,range_x
+        else:
+            chunk_min,chunk_range=min_x[chunk],range_x[chunk]
+        np.subtract(x[chunk],chunk_min,out=out[chunk])
+        np.divide(out[chunk],chunk_range,out=out[chunk])
     
+    if isinstance(out,np.memmap):
+        out.flush()
+    norm_x=out
     return norm_x
 
 
+@timed()
 def closest_distance(x,y,xo,yo,n):
     """
     search the closest non-repitiong points to xo and yo.
@@ -358,6 +433,7 @@ def closest_distance(x,y,xo,yo,n):
     return bool_selected_node
 
 
+@timed()
 def read_parameters_table(path,n):
     """
     Read table with several parameters required to compute
@@ -398,6 +474,8 @@ def read_parameters_table(path,n):
     final_data dimension: (2,10)
     """
     
+    from astropy.table import Table
+    
     tab=Table.read(path, format='ascii')
 
     #dict with colname and unique values of the parameter variables
@@ -405,7 +483,8 @@ def read_parameters_table(path,n):
     #size unique values for each colname of the parameter variables
     col_n_values=[]
     
-    print(tab.colnames)
+    log("read_parameters_table","columns %s",tab.colnames)
+    count("read_parameters_table","rows",len(tab))
     #get the parameter values
     for col in tab.colnames[:-n]:
         unique_val=np.unique(tab[col])
@@ -414,7 +493,7 @@ def read_parameters_table(path,n):
 
     #sort size to have ascendent order
     arg_order_size=np.argsort(col_n_values)
-    print(col_n_values)
+    log("read_parameters_table","number of values %s",col_n_values)
     
     #obtain the names in sorted order
     axis_name_array=[]
@@ -440,9 +519,9 @@ def read_parameters_table(path,n):
     #arg of the name to exclude. To avoid swaping again
     skip_arg_name=1000
     
-    print("old",col_values.keys())
-    print("new",axis_name_array)
-    print("new shape",new_shape)
+    log("read_parameters_table","old %s",col_values.keys())
+    log("read_parameters_table","new %s",axis_name_array)
+    log("read_parameters_table","new shape %s",new_shape)
 
     #swap the axes that are not ordered in the colname order
     new=new_shape
@@ -461,5 +540,744 @@ def read_parameters_table(path,n):
                     skip_arg_name=arg_name
 
     final_data=data
-    print("final shape",np.shape(final_data))
+    log("read_parameters_table","final shape %s",np.shape(final_data))
     return axes_values,final_data
+
+
+def _read_table_header(path,delimiter=None):
+    """
+    Find the column names of an ASCII table and the number of lines
+    before the first data row.
+    
+    The header is the first non-commented line. If that line is already
+    numeric, the last commented line is used as header (commented header).
+    """
+    
+    last_comment=None
+    with open(path,'r') as file:
+        for nline,line in enumerate(file):
+            stripped=line.strip()
+            if stripped=="":
+                continue
+            if stripped.startswith("#"):
+                last_comment=stripped.lstrip("#")
+                continue
+            try:
+                [float(val) for val in stripped.split(delimiter)]
+            except ValueError:
+                return [col.strip() for col in stripped.split(delimiter)],nline+1
+            if last_comment==None:
+                raise ValueError(f"Table {path} does not have a header with the column names")
+            return [col.strip() for col in last_comment.split(delimiter)],nline
+            
+    raise ValueError(f"Table {path} does not have any data")
+
+
+def _iter_table_chunks(path,chunk_size,delimiter=None):
+    """
+    Yield the data rows of an ASCII table as 2-dimensional np.array
+    of at most chunk_size rows.
+    """
+    
+    colnames,n_skip=_read_table_header(path,delimiter)
+    with open(path,'r') as file:
+        lines=itertools.islice(file,n_skip,None)
+        while True:
+            chunk=list(itertools.islice(lines,chunk_size))
+            if len(chunk)==0:
+                break
+            chunk=[line for line in chunk if line.strip()!="" and not line.lstrip().startswith("#")]
+            if len(chunk)==0:
+                continue
+            data=np.loadtxt(chunk,delimiter=delimiter,ndmin=2)
+            if data.shape[1]!=len(colnames):
+                raise ValueError(f"Rows of {path} have {data.shape[1]} columns but the header has {len(colnames)}")
+            yield data
+
+
+def _grid_indices(params,axes_values,order):
+    """
+    Index of each row of params in the grid with axes axes_values.
+    order gives the column of params corresponding to each axis.
+    """
+    
+    return tuple(np.searchsorted(axes_values[iaxis],params[:,col]) for iaxis,col in enumerate(order))
+
+
+@timed()
+def read_parameters_table_chunked(path,n,chunk_size=1000000,memmap_path=None,delimiter=None,fill_value=np.nan):
+    """
+    Read table with several parameters required to compute the last
+    n columns of the table, streaming the table in chunks of rows.
+    
+    Same as read_parameters_table but the memory used is bounded by
+    chunk_size, so tables larger than the memory can be read. The table
+    is read twice: the first pass finds the unique values of the parameters
+    and the second one scatters the results of each chunk into a grid
+    stored on disk (np.memmap). The position of each row in the grid is
+    found from its parameter values, so the rows can be in any order.
+    
+    Only plain ASCII tables (header with the column names followed by
+    the data) where the parameters form a grid are supported. Units
+    are not read.
+    
+    Parameters
+    ----------
+    path: string
+        Path to table.
+    n: int
+        Number of columns that are the results of using the parameters 
+        in the columns 0,..,n-1 of the table.
+    chunk_size: int
+        Number of rows read at once.
+    memmap_path: string or None
+        File where the grid is stored. If None, a temporary file is created
+        and it is not removed afterwards.
+    delimiter: string or None
+        Column delimiter. If None, any whitespace.
+    fill_value: float
+        Value of the nodes of the grid that are not in the table.
+        
+    Returns
+    -------
+    axes_values: list
+        List with the variables values ordered from shorter parameter
+        values to longer ones.
+    final_data: np.memmap
+        Grid with the n column results. The first dimension are the n
+        columns and the rest the parameter values in the order of axes_values.
+    """
+    
+    colnames,_=_read_table_header(path,delimiter)
+    n_params=len(colnames)-n
+    if n_params<1:
+        raise ValueError(f"The table has {len(colnames)} columns, not enough for {n} results")
+
+    #first pass: unique values of the parameter variables
+    col_values=[np.array([]) for _ in range(n_params)]
+    for data in _iter_table_chunks(path,chunk_size,delimiter):
+        for i in range(n_params):
+            col_values[i]=np.union1d(col_values[i],data[:,i])
+
+    #sort size to have ascendent order
+    col_n_values=[len(values) for values in col_values]
+    arg_order_size=np.argsort(col_n_values,kind="stable")
+    axes_values=[col_values[i] for i in arg_order_size]
+    new_shape=tuple(col_n_values[i] for i in arg_order_size)
+
+    if memmap_path==None:
+        with tempfile.NamedTemporaryFile(suffix=".dat",delete=False) as file:
+            memmap_path=file.name
+    final_data=np.memmap(memmap_path,dtype=np.float64,mode="w+",shape=(n,)+new_shape)
+    final_data[:]=fill_value
+
+    #second pass: scatter the results in the grid
+    for data in _iter_table_chunks(path,chunk_size,delimiter):
+        index=_grid_indices(data[:,:n_params],axes_values,arg_order_size)
+        for k in range(n):
+            final_data[(k,)+index]=data[:,n_params+k]
+
+    final_data.flush()
+    return axes_values,final_data
+
+
+class grid_interpolator:
+    """
+    Interpolate the results of read_parameters_table at any value of the 
+    parameters. The grid is stored once as a contiguous array, all the
+    result columns are interpolated at once and the queries are
+    vectorized, so build it once and evaluate it with large batches of
+    points. The object can be pickled to send it to worker processes.
+    """
+    
+    def __init__(self,axes_values,final_data,method="linear",fill_value=np.nan):
+        """
+        Parameters
+        ----------
+        axes_values: list
+            Values of each parameter, as returned by read_parameters_table.
+        final_data: list
+            Results in the grid of parameter values, as returned by 
+            read_parameters_table.
+        method: str
+            Default interpolation method. Options: linear, nearest.
+        fill_value: float or None
+            Value returned for points outside the grid. If None, the
+            values are extrapolated.
+        """
+        
+        self.axes_values=[np.asarray(values,dtype=np.float64) for values in axes_values]
+        shape=tuple(len(values) for values in self.axes_values)
+        for values in self.axes_values:
+            if len(values)>1 and np.any(np.diff(values)<=0):
+                raise ValueError("The values of each axis must be strictly increasing")
+        
+        self.units=[getattr(dat,"unit",None) for dat in final_data]
+        values=[np.asarray(getattr(dat,"value",dat),dtype=np.float64) for dat in final_data]
+        for dat in values:
+            if dat.shape!=shape:
+                raise ValueError(f"The results have shape {dat.shape} but the axes give the shape {shape}")
+        #flatten the grid: one row per result column
+        self.values=np.ascontiguousarray(np.reshape(values,(len(values),-1)))
+        #step in the flattened grid for each axis
+        self.strides=np.array([int(np.prod(shape[i+1:])) for i in range(len(shape))],dtype=np.int64)
+        
+        self.check_method(method)
+        self.method=method
+        self.fill_value=fill_value
+        
+    @classmethod
+    def from_parameters_table(cls,path,n,**kwargs):
+        """
+        Read the table with read_parameters_table and build the interpolator.
+        kwargs are passed to grid_interpolator.
+        """
+        axes_values,final_data=read_parameters_table(path,n)
+        return cls(axes_values,final_data,**kwargs)
+        
+    @staticmethod
+    def check_method(method):
+        if method not in ["linear","nearest"]:
+            raise ValueError("Error, available methods are: linear, nearest")
+        
+    def _locate(self,points):
+        """
+        Lower index of the cell of each point in each axis, the fractional
+        position inside the cell and whether the point is in the grid.
+        """
+        
+        index=np.empty(points.shape,dtype=np.int64)
+        frac=np.empty(points.shape,dtype=np.float64)
+        in_grid=np.ones(points.shape[0],dtype=bool)
+        for i,values in enumerate(self.axes_values):
+            p=points[:,i]
+            if len(values)==1:
+                index[:,i]=0
+                frac[:,i]=0
+                in_grid&=(p==values[0])
+                continue
+            idx=np.clip(np.searchsorted(values,p,side="right")-1,0,len(values)-2)
+            index[:,i]=idx
+            frac[:,i]=(p-values[idx])/(values[idx+1]-values[idx])
+            in_grid&=(p>=values[0])&(p<=values[-1])
+        return index,frac,in_grid
+
+    @timed()
+    def __call__(self,points,method=None):
+        """
+        Evaluate the interpolation.
+        
+        Parameters
+        ----------
+        points: np.array
+            Points with shape (m, number of axes). A tuple with one array
+            per axis is also valid; the arrays are broadcast together.
+        method: str or None
+            Interpolation method. If None, the default one.
+            
+        Returns
+        -------
+        result: list
+            List with the n interpolated result columns, each one with the
+            shape of the query points.
+        """
+        
+        if method==None:
+            method=self.method
+        self.check_method(method)
+
+        n_axes=len(self.axes_values)
+        if isinstance(points,tuple):
+            arrays=np.broadcast_arrays(*[np.asarray(p,dtype=np.float64) for p in points])
+            out_shape=arrays[0].shape
+            points=np.stack([a.ravel() for a in arrays],axis=-1)
+        else:
+            points=np.asarray(points,dtype=np.float64)
+            out_shape=points.shape[:-1]
+            if np.ndim(points)==0 or points.shape[-1]!=n_axes:
+                raise ValueError(f"The points must have {n_axes} coordinates, one per axis of the grid")
+            points=points.reshape(-1,n_axes)
+        if points.shape[1]!=n_axes:
+            raise ValueError(f"The points must have {n_axes} coordinates, one per axis of the grid")
+
+        index,frac,in_grid=self._locate(points)
+        if method=="nearest":
+            index=index+(frac>=0.5)
+            flat_index=np.zeros(points.shape[0],dtype=np.int64)
+            for i,values in enumerate(self.axes_values):
+                flat_index+=np.minimum(index[:,i],len(values)-1)*self.strides[i]
+            result=np.take(self.values,flat_index,axis=1)
+        else:
+            #flattened index and weight of the lower and upper side of the cell in each axis
+            sides=[]
+            for i,values in enumerate(self.axes_values):
+                lower=index[:,i]*self.strides[i]
+                step=self.strides[i] if len(values)>1 else 0
+                sides.append(((lower,1-frac[:,i]),(lower+step,frac[:,i])))
+            #sum over the 2^n corners of the cell
+            result=np.zeros((self.values.shape[0],points.shape[0]))
+            for corner in itertools.product(*sides):
+                flat_index=corner[0][0]
+                weight=corner[0][1]
+                for lower,w in corner[1:]:
+                    flat_index=flat_index+lower
+                    weight=weight*w
+                result+=weight*np.take(self.values,flat_index,axis=1)
+        
+        if self.fill_value is not None:
+            result[:,~in_grid]=self.fill_value
+
+        result=result.reshape((self.values.shape[0],)+out_shape)
+        return [res*unit if unit is not None else res for res,unit in zip(result,self.units)]
+
+
+def build_axes_index(axes_values):
+    """
+    Build a hash map from value to index for each axis returned by
+    read_parameters_table.
+    
+    Parameters
+    ----------
+    axes_values: list
+        Values of each parameter.
+        
+    Returns
+    -------
+    axes_index: list
+        List with one dict per axis with the parameter values as keys
+        and their index in the axis as values.
+    """
+    
+    return [{value:i for i,value in enumerate(np.asarray(values).tolist())} for values in axes_values]
+
+
+class parameters_index:
+    """
+    Exact lookup of the results of read_parameters_table for given
+    parameter values. Each value is converted to its index in the axis
+    through a hash map, and the results of many parameter tuples are
+    gathered at once.
+    """
+    
+    def __init__(self,axes_values,final_data):
+        """
+        Parameters
+        ----------
+        axes_values: list
+            Values of each parameter, as returned by read_parameters_table.
+        final_data: list
+            Results in the grid of parameter values, as returned by 
+            read_parameters_table.
+        """
+        
+        self.axes_values=[np.asarray(values) for values in axes_values]
+        self.axes_index=build_axes_index(self.axes_values)
+        shape=tuple(len(values) for values in self.axes_values)
+        
+        self.units=[getattr(dat,"unit",None) for dat in final_data]
+        self.values=np.stack([np.asarray(getattr(dat,"value",dat)) for dat in final_data])
+        if self.values.shape[1:]!=shape:
+            raise ValueError(f"The results have shape {self.values.shape[1:]} but the axes give the shape {shape}")
+        
+    @classmethod
+    def from_parameters_table(cls,path,n):
+        """
+        Read the table with read_parameters_table and build the index.
+        """
+        axes_values,final_data=read_parameters_table(path,n)
+        return cls(axes_values,final_data)
+        
+    def index(self,param_arrays):
+        """
+        Index in the grid of the parameter values.
+        
+        Parameters
+        ----------
+        param_arrays: list
+            List with one array per axis (same order as axes_values) with
+            the parameter values. The arrays are broadcast together.
+        
+        Returns
+        -------
+        index: tuple
+            Tuple with the index array of each axis.
+        """
+        
+        if len(param_arrays)!=len(self.axes_index):
+            raise ValueError(f"{len(param_arrays)} parameter arrays given but the grid has {len(self.axes_index)} axes")
+        arrays=np.broadcast_arrays(*[np.asarray(values) for values in param_arrays])
+        
+        index=[]
+        for i,(mapping,values) in enumerate(zip(self.axes_index,arrays)):
+            try:
+                idx=np.fromiter(map(mapping.__getitem__,values.ravel().tolist()),dtype=np.int64,count=values.size)
+            except KeyError as err:
+                raise KeyError(f"Value {err.args[0]} is not in the axis {i}") from None
+            index.append(idx.reshape(values.shape))
+        return tuple(index)
+        
+    @timed()
+    def lookup(self,param_arrays):
+        """
+        Results for the given parameter values.
+        
+        Parameters
+        ----------
+        param_arrays: list
+            List with one array per axis (same order as axes_values) with
+            the parameter values. The arrays are broadcast together.
+            
+        Returns
+        -------
+        result: list
+            List with the n result columns, each one with the broadcast
+            shape of param_arrays.
+        """
+        
+        result=self.values[(slice(None),)+self.index(param_arrays)]
+        return [res*unit if unit is not None else res for res,unit in zip(result,self.units)]
+
+
+def _table_cache_path(path,cache_dir=None):
+    """Path of the binary cache of an ASCII table."""
+    path=Path(path)
+    if cache_dir==None:
+        return path.parent/f".{path.name}.cache.npz"
+    #stable digest, hash() of str changes between interpreters
+    digest=hashlib.sha1(str(path.resolve()).encode()).hexdigest()
+    return Path(cache_dir)/f"{path.name}.{digest}.cache.npz"
+
+
+def _read_table_columns(path,cache_dir=None):
+    """
+    Read all the columns of an ASCII table as a 2-dimensional array,
+    with the column names and units.
+    
+    The result is stored in a binary .npz file, which is read instead of
+    the table while the table is not modified (same size and modification
+    time). If the cache cannot be written, the table is read anyway.
+    """
+    
+    from astropy.table import Table
+    
+    path=Path(path)
+    stat=path.stat()
+    cache_path=_table_cache_path(path,cache_dir)
+    if cache_path.exists():
+        with np.load(cache_path,allow_pickle=False) as cache:
+            if cache["mtime_ns"]==stat.st_mtime_ns and cache["size"]==stat.st_size:
+                return cache["colnames"].tolist(),cache["units"].tolist(),cache["data"]
+    
+    tab=Table.read(path,format='ascii')
+    colnames=tab.colnames
+    units=[str(tab[col].unit) if tab[col].unit is not None else "" for col in colnames]
+    data=np.column_stack([np.asarray(tab[col],dtype=np.float64) for col in colnames])
+
+    #write to a temporary file first, so other processes never read half a cache
+    file=None
+    try:
+        cache_path.parent.mkdir(parents=True,exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent,suffix=".npz",delete=False) as file:
+            np.savez(file,colnames=np.array(colnames),units=np.array(units),data=data,
+                     mtime_ns=stat.st_mtime_ns,size=stat.st_size)
+        os.replace(file.name,cache_path)
+    except OSError as err:
+        #e.g. read-only directory, the table is read without cache
+        log("read_parameters_tables","cache of %s not written: %s",path,err)
+        if file!=None and os.path.exists(file.name):
+            os.remove(file.name)
+    return colnames,units,data
+
+
+@timed()
+def read_parameters_tables(paths,n,n_workers=None,cache_dir=None):
+    """
+    Read several tables with the layout of read_parameters_table and
+    merge them into a single grid. Use it when a scan is split into
+    many files, each with part of the grid.
+    
+    The tables are read in parallel in a pool of processes. Each table
+    is cached in a binary file (see cache_dir), so tables that have
+    not been modified since the last call are not parsed again.
+    
+    Parameters
+    ----------
+    paths: list
+        Paths to the tables.
+    n: int
+        Number of columns that are the results of using the parameters 
+        in the columns 0,..,n-1 of the tables.
+    n_workers: int or None
+        Number of processes. If None, the number of CPUs. If 1, the
+        tables are read in this process.
+    cache_dir: string or None
+        Directory with the binary caches. If None, the cache of each table
+        is stored next to it as a hidden file.
+        
+    Returns
+    -------
+    axes_values: list
+        List with the variables values ordered from shorter parameter
+        values to longer ones.
+    final_data: list
+        List with the n result columns in the grid of parameter values.
+        Nodes of the grid that are not in any table are NaN.
+    """
+    
+    from astropy import units as u
+    from concurrent.futures import ProcessPoolExecutor
+    
+    paths=[str(path) for path in paths]
+    if len(paths)==0:
+        raise ValueError("No tables to read")
+        
+    if n_workers==1:
+        tables=[_read_table_columns(path,cache_dir) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            tables=list(pool.map(_read_table_columns,paths,itertools.repeat(cache_dir)))
+
+    #check that all the tables are compatible
+    colnames,units,_=tables[0]
+    for path,(icolnames,iunits,_) in zip(paths[1:],tables[1:]):
+        if icolnames!=colnames:
+            raise ValueError(f"Columns of {path} ({icolnames}) differ from the ones of {paths[0]} ({colnames})")
+        if iunits!=units:
+            raise ValueError(f"Units of {path} ({iunits}) differ from the ones of {paths[0]} ({units})")
+    n_params=len(colnames)-n
+    if n_params<1:
+        raise ValueError(f"The tables have {len(colnames)} columns, not enough for {n} results")
+        
+    #unique values of the parameter variables of all the tables
+    col_values=[np.unique(np.concatenate([data[:,i] for _,_,data in tables])) for i in range(n_params)]
+    col_n_values=[len(values) for values in col_values]
+    arg_order_size=np.argsort(col_n_values,kind="stable")
+    axes_values=[col_values[i] for i in arg_order_size]
+    new_shape=tuple(col_n_values[i] for i in arg_order_size)
+
+    #scatter the results of each table in the grid
+    final=np.full((n,)+new_shape,np.nan)
+    counts=np.zeros(new_shape,dtype=np.int64)
+    for _,_,data in tables:
+        index=_grid_indices(data[:,:n_params],axes_values,arg_order_size)
+        np.add.at(counts,index,1)
+        final[(slice(None),)+index]=data[:,n_params:].T
+    if np.any(counts>1):
+        raise ValueError(f"{np.sum(counts>1)} nodes of the grid are repeated in the tables")
+        
+    final_data=[]
+    for k in range(n):
+        unit=units[n_params+k]
+        final_data.append(final[k]*u.Unit(unit) if unit!="" else final[k])
+    return axes_values,final_data
+
+
+def _round_half_even_next_digit(q):
+    """
+    Round q (positive) to an integer as significant_digits does: if the
+    first decimal is a 5, round to the even integer, else usual rounding.
+    """
+    integer=np.floor(q)
+    first_decimal=np.floor(np.round((q-integer)*10,5))
+    round_up=np.where(first_decimal==5,integer%2==1,first_decimal>5)
+    return integer+round_up
+
+
+def format_significant_digits(values,errors,precision=1):
+    """
+    Round many values and their uncertainties at once, with the rounding
+    rules of significant_digits: the uncertainty keeps precision significant
+    figures (one more if the first one is a 1), the value is rounded to the
+    same decimal, and a 5 after the last kept digit rounds to even.
+    The rounded numbers are the same as with significant_digits, except
+    that negative values are rounded as positive ones. The strings can
+    differ: they always show the decimals down to the last kept digit of
+    the uncertainty, keeping the trailing zeros (e.g. "3.30 ± 0.13" and
+    "6.620 ± 0.010", where significant_digits gives "3.3 ± 0.13" and
+    "6.620 ± 0.01"), and they are never in scientific notation.
+    
+    Parameters
+    ----------
+    values: np.array
+        Values to round.
+    errors: np.array
+        Uncertainties of the values.
+    precision: int
+        Number of significant figures of the uncertainties.
+        
+    Returns
+    -------
+    values_str: np.array
+        Rounded values as strings.
+    errors_str: np.array
+        Rounded uncertainties as strings.
+    """
+    
+    values=np.asarray(values,dtype=np.float64)
+    errors=np.abs(np.asarray(errors,dtype=np.float64))
+    values,errors=np.broadcast_arrays(values,errors)
+    if np.any(errors==0):
+        raise ValueError("Uncertainty is zero!")
+    
+    finite=np.isfinite(values)&np.isfinite(errors)
+    safe_errors=np.where(finite,errors,1.)
+    safe_values=np.where(finite,values,0.)
+    
+    #position of the first significant figure of the errors
+    exponent=np.floor(np.log10(safe_errors))
+    leading_digit=np.floor(np.round(safe_errors/10**exponent,10))
+    #correct log10 inaccuracies, e.g. for 1000
+    exponent=np.where(leading_digit>=10,exponent+1,exponent)
+    leading_digit=np.where(leading_digit>=10,1,leading_digit)
+    #decimal position of the last kept digit
+    last_digit=exponent-(precision-1)-(leading_digit==1)
+    scale=10**last_digit
+    
+    rounded_errors=_round_half_even_next_digit(np.round(safe_errors/scale,10))*scale
+    rounded_values=np.sign(safe_values)*_round_half_even_next_digit(np.round(np.abs(safe_values)/scale,10))*scale
+    #avoid -0
+    rounded_values=rounded_values+0.
+    
+    decimals=np.clip(-last_digit,0,None).astype(int)
+    values_str=np.empty(values.shape,dtype=object)
+    errors_str=np.empty(values.shape,dtype=object)
+    for ndecimals in np.unique(decimals):
+        mask=(decimals==ndecimals)
+        values_str[mask]=np.char.mod(f"%.{ndecimals}f",rounded_values[mask])
+        errors_str[mask]=np.char.mod(f"%.{ndecimals}f",rounded_errors[mask])
+    values_str[~finite]=np.char.mod("%s",values[~finite])
+    errors_str[~finite]=np.char.mod("%s",errors[~finite])
+    
+    return values_str.astype(str),errors_str.astype(str)
+
+
+def _format_significant_figures(values,precision):
+    """
+    Round values without uncertainty to precision significant figures,
+    with the rounding of format_significant_digits (a 5 after the last 
+    kept digit rounds to even), as strings.
+    """
+    values=np.asarray(values,dtype=np.float64)
+    finite=np.isfinite(values)&(values!=0)
+    safe_values=np.where(finite,values,1.)
+    
+    exponent=np.floor(np.log10(np.abs(safe_values)))
+    #correct log10 inaccuracies, e.g. for 1000
+    exponent=np.where(np.floor(np.round(np.abs(safe_values)/10**exponent,10))>=10,exponent+1,exponent)
+    last_digit=exponent-(precision-1)
+    scale=10**last_digit
+    rounded=np.sign(safe_values)*_round_half_even_next_digit(np.round(np.abs(safe_values)/scale,10))*scale
+    
+    decimals=np.clip(-last_digit,0,None).astype(int)
+    values_str=np.empty(values.shape,dtype=object)
+    for ndecimals in np.unique(decimals):
+        mask=(decimals==ndecimals)
+        values_str[mask]=np.char.mod(f"%.{ndecimals}f",rounded[mask])
+    values_str[~finite]=np.char.mod("%g",values[~finite])
+    return values_str.astype(str)
+
+
+def _latex_escape(strings):
+    """Escape the characters with a special meaning in LaTeX."""
+    strings=np.asarray(strings).astype(str)
+    for char in ["{","}","_","%","&","#","$"]:
+        strings=np.char.replace(strings,char,"\\"+char)
+    return strings
+
+
+def write_results_table(table,pairs,file_name,format="latex",precision=1,columns=None,float_precision=3):
+    """
+    Write a table of results with uncertainties, rounded with the rules
+    of significant_digits. All the pairs are rounded at once and the file
+    is written in a single operation.
+    
+    Parameters
+    ----------
+    table: astropy.table.Table or dict
+        Table with the columns, or dict with the column names as keys 
+        and np.array as values.
+    pairs: list
+        List of (value column, uncertainty column). The output column
+        has the name of the value column.
+    file_name: str
+        Output file.
+    format: str
+        Format of the output: latex, ecsv or markdown. In latex and 
+        markdown, each pair is a single column "value ± uncertainty". In
+        ecsv, the rounded value and uncertainty are kept in two columns.
+    precision: int
+        Number of significant figures of the uncertainties.
+    columns: list or None
+        Columns written, in order. The value columns of the pairs are 
+        written with their uncertainty. If None, all the columns except
+        the uncertainty columns of the pairs.
+    float_precision: int
+        Number of significant figures of the float columns that are not
+        in pairs, in latex and markdown. In latex, the column names and
+        the text columns are escaped.
+    """
+    
+    if format not in ["latex","ecsv","markdown"]:
+        raise ValueError("Error, available formats are: latex, ecsv, markdown")
+    
+    colnames=list(table.colnames) if hasattr(table,"colnames") else list(table.keys())
+    error_of={value_col:error_col for value_col,error_col in pairs}
+    if columns==None:
+        error_cols=set(error_of.values())
+        columns=[col for col in colnames if col not in error_cols]
+    
+    #all the pairs rounded together
+    values=np.concatenate([np.ravel(np.asarray(table[value_col],dtype=np.float64)) for value_col,_ in pairs]) if len(pairs)>0 else np.array([])
+    errors=np.concatenate([np.ravel(np.asarray(table[error_col],dtype=np.float64)) for _,error_col in pairs]) if len(pairs)>0 else np.array([])
+    values_str,errors_str=format_significant_digits(values,errors,precision)
+    formatted={}
+    start=0
+    for value_col,_ in pairs:
+        n_rows=len(table[value_col])
+        formatted[value_col]=(values_str[start:start+n_rows],errors_str[start:start+n_rows])
+        start+=n_rows
+    
+    buffer=io.StringIO()
+    if format=="ecsv":
+        from astropy.table import Table
+        
+        out=Table()
+        for col in columns:
+            if col in error_of:
+                out[col]=formatted[col][0]
+                out[error_of[col]]=formatted[col][1]
+            else:
+                out[col]=table[col]
+        out.write(buffer,format="ascii.ecsv")
+    else:
+        cells=[]
+        for col in columns:
+            if col in error_of:
+                if format=="latex":
+                    cells.append(np.char.add(np.char.add(np.char.add("$",formatted[col][0]),r" \pm "),
+                                             np.char.add(formatted[col][1],"$")))
+                else:
+                    cells.append(np.char.add(np.char.add(formatted[col][0]," ± "),formatted[col][1]))
+            else:
+                column=np.asarray(table[col])
+                if np.issubdtype(column.dtype,np.floating):
+                    column=_format_significant_figures(column,float_precision)
+                else:
+                    column=column.astype(str)
+                    if format=="latex":
+                        column=_latex_escape(column)
+                cells.append(column)
+        rows=np.array(cells).T if len(cells)>0 else np.empty((0,0))
+        
+        if format=="latex":
+            buffer.write("\\begin{tabular}{"+"c"*len(columns)+"}\n\\hline\n")
+            buffer.write(" & ".join(_latex_escape(columns))+" \\\\\n\\hline\n")
+            buffer.write("".join(" & ".join(row)+" \\\\\n" for row in rows))
+            buffer.write("\\hline\n\\end{tabular}\n")
+        else:
+            buffer.write("| "+" | ".join(columns)+" |\n")
+            buffer.write("|"+"---|"*len(columns)+"\n")
+            buffer.write("".join("| "+" | ".join(row)+" |\n" for row in rows))
+            
+    with open(file_name,"w") as file:
+        file.write(buffer.getvalue())
@@ -1,51 +1,171 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from .utils import significant_digits
+from .instrumentation import count, log, timed
 from matplotlib.transforms import Bbox
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
+from matplotlib.gridspec import GridSpec
 import matplotlib
 import string
-import astropy.units as u
+import contextlib
+import copy
+import functools
 import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 __all__=[
     "avoid_bbox_overlap",
     "add_panel_labels",    
     "add_text_info",
+    "clear_text_extent_cache",
+    "correct_display_flux_units",
+    "correct_display_flux_units_list",
+    "figure_template",
+    "figure_writer",
+    "insert_labels",
     "manage_number_axes",
+    "measure_text_extents",
+    "place_texts",
+    "plot_density",
     "plot_parameter_value",
     "plot_preliminary_text",
+    "rcParams_style",
+    "resolve_bbox_overlap",
     "update_2cool_rcParams",
     "text_in_figure_borders",
 ]
 
-import itertools
+#offsets of the text extents with respect to their anchor point, see measure_text_extents
+_TEXT_EXTENT_CACHE={}
+_TEXT_EXTENT_CACHE_SIZE=10000
 
-import matplotlib
-import itertools
 
-import matplotlib
-import itertools
+def _get_renderer(fig,update_layout=False):
+    """
+    Renderer of the figure, without drawing it. The Agg canvas keeps
+    the renderer while the size and dpi of the figure do not change.
+    If update_layout is True and the figure has a layout engine, the 
+    layout is updated first (it is slow, do it once per batch of texts).
+    """
+    if update_layout and fig.get_layout_engine() is not None:
+        fig.get_layout_engine().execute(fig)
+    if hasattr(fig.canvas,"get_renderer"):
+        return fig.canvas.get_renderer()
+    fig.canvas.draw()
+    return fig.canvas.renderer
+
+
+def _text_extent_key(txt,dpi):
+    """
+    Key of the text in the extent cache, or None if the extent of the text
+    cannot be cached (its size depends on something else than its properties).
+    """
+    if type(txt) is not matplotlib.text.Text or not txt.get_visible() or txt.get_wrap():
+        return None
+    if txt.get_transform_rotates_text():
+        return None
+    #copy of the font properties: set_size and others modify them in place
+    return (txt.get_text(),txt.get_fontproperties().copy(),txt.get_rotation(),txt.get_rotation_mode(),
+            txt.get_horizontalalignment(),txt.get_verticalalignment(),txt._linespacing,
+            txt.get_usetex(),dpi)
+
+
+def clear_text_extent_cache():
+    """Remove all the text extents stored by measure_text_extents."""
+    _TEXT_EXTENT_CACHE.clear()
+
 
+@timed()
+def measure_text_extents(fig,txts,renderer=None):
+    """
+    Get the extent in display coordinates (pixels) of many texts without
+    drawing the figure.
+    
+    The size of a text only depends on its string, font properties,
+    rotation, alignment and the figure dpi, so the offsets of the extent
+    with respect to the position of the text are cached with those
+    properties as key. Identical texts (also in other figures) are
+    measured only once, and only the positions are transformed.
+    
+    Parameters
+    ----------
+    fig: matplotlib.pyplot.figure
+        Figure
+    txts: list
+        List of matplotlib.text.Text
+    renderer: matplotlib.backend_bases.RendererBase or None
+        Renderer used to measure. If None, the renderer of the figure canvas.
+        
+    Returns
+    -------
+    extents: np.array
+        Array with shape (len(txts), 4) with x0, y0, x1, y1 of each text.
+    """
+    
+    if renderer==None:
+        renderer=_get_renderer(fig)
+    
+    #update the limits of the axes (done when drawing)
+    for ax in set(txt.axes for txt in txts if txt.axes is not None):
+        ax.viewLim
+        
+    #position in pixels, transformed together for texts with the same transform
+    anchors=np.zeros((len(txts),2))
+    groups={}
+    for itxt,txt in enumerate(txts):
+        trans=txt.get_transform()
+        groups.setdefault(id(trans),(trans,[]))[1].append(itxt)
+    for trans,index in groups.values():
+        anchors[index]=trans.transform([txts[itxt].get_unitless_position() for itxt in index])
+
+    count("measure_text_extents","texts",len(txts))
+    extents=np.empty((len(txts),4))
+    for itxt,txt in enumerate(txts):
+        key=_text_extent_key(txt,fig.dpi)
+        offsets=_TEXT_EXTENT_CACHE.get(key) if key is not None else None
+        if offsets==None:
+            count("measure_text_extents","measured")
+            bbox=txt.get_window_extent(renderer)
+            if key==None:
+                extents[itxt]=bbox.extents
+                continue
+            offsets=tuple(bbox.extents-np.tile(anchors[itxt],2))
+            if len(_TEXT_EXTENT_CACHE)>=_TEXT_EXTENT_CACHE_SIZE:
+                _TEXT_EXTENT_CACHE.clear()
+            _TEXT_EXTENT_CACHE[key]=offsets
+        extents[itxt]=np.tile(anchors[itxt],2)+offsets
+        
+    return extents
+
+
+def _axes_texts(ax):
+    """Texts of the axes except the title"""
+    txts=[]
+    for child in ax.get_children():
+        if isinstance(child,matplotlib.text.Text):
+            if child.get_text()!=ax.get_title():
+                txts.append(child)
+    return txts
+
+
+@timed()
 def avoid_bbox_overlap(fig,ax,txts=None):
     """avoid overlap between boxes of different texts"""
-    fig.canvas.draw()
     max_intersect_area=0.1
     if txts==None:
-        txts=[]
-        for child in ax.get_children():
-            if isinstance(child,matplotlib.text.Text):
-                if child.get_text()!=ax.get_title():
-                    txts.append(child)        
+        txts=_axes_texts(ax)
 
     # get the inverse of the transformation from data coordinates to pixels
     transf = ax.transData.inverted()
     bboxes=[]
-    for txt in txts:
-        bb = txt.get_window_extent(renderer = fig.canvas.renderer)
-        bboxes.append(bb.transformed(transf))
+    for extent in measure_text_extents(fig,txts):
+        bboxes.append(Bbox.from_extents(*extent).transformed(transf))
 
     list_modif=[]
     combinations_bb=list(itertools.combinations(bboxes, 2))
+    count("avoid_bbox_overlap","pairs",len(combinations_bb))
     for ii in range(len(combinations_bb)):
         ibbox=combinations_bb[ii][0]
         ibbox_width=ibbox.width
@@ -88,7 +208,7 @@ def avoid_bbox_overlap(fig,ax,txts=None):
 
                         elif cont_arg2==0:                                    
                             iarea_ratio,yarea_ratio=0,0
-                            print("------------NOT possible to move --------")
+                            log("avoid_bbox_overlap","not possible to move the text")
                                                         
                     ypoints[0][cont_arg2]+=size_catet*cont/10
                     ypoints[0+1][cont_arg2]+=size_catet*cont/10
@@ -106,6 +226,506 @@ def avoid_bbox_overlap(fig,ax,txts=None):
 
     return fig,ax
 
+def _overlapping_pairs(boxes,max_intersect_area):
+    """
+    Find the pairs of boxes whose intersection area is larger than
+    max_intersect_area times the area of the smaller box of the pair.
+    
+    Candidates are found with a sweep line: after sorting the boxes by
+    their lower edge along the sweep axis, box i can only overlap the
+    boxes whose lower edge is between the lower and upper edges of box i.
+    The sweep is done along the axis where the boxes are smaller compared
+    to their spread, which gives fewer candidates.
+    
+    Parameters
+    ----------
+    boxes: np.array
+        Array with shape (n, 4) with x0, y0, x1, y1 of each box.
+    max_intersect_area: float
+        Maximum fraction of the area of a box that can be overlapped.
+        
+    Returns
+    -------
+    i, j: np.array
+        Index of the boxes of each overlapping pair.
+    width, height: np.array
+        Size of the intersection of each pair.
+    """
+    
+    if len(boxes)<2:
+        empty=np.array([],dtype=int)
+        return empty,empty,np.array([]),np.array([])
+    size=boxes[:,2:]-boxes[:,:2]
+    spread=np.ptp(boxes[:,:2],axis=0)+np.finfo(float).tiny
+    sweep=np.argmin(np.mean(size,axis=0)/spread)
+    
+    order=np.argsort(boxes[:,sweep],kind="stable")
+    lower_sorted=boxes[order,sweep]
+    end=np.searchsorted(lower_sorted,boxes[order,sweep+2],side="left")
+    counts=np.maximum(end-np.arange(len(order))-1,0)
+    
+    #all the candidate pairs (i,j) with j after i in the sorted order
+    i=np.repeat(np.arange(len(order)),counts)
+    j=i+1+np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+    i,j=order[i],order[j]
+    
+    #discard first the candidates that do not overlap in the other axis
+    other=1-sweep
+    other_size=np.minimum(boxes[i,other+2],boxes[j,other+2])-np.maximum(boxes[i,other],boxes[j,other])
+    close=other_size>0
+    i,j,other_size=i[close],j[close],other_size[close]
+    sweep_size=np.minimum(boxes[i,sweep+2],boxes[j,sweep+2])-np.maximum(boxes[i,sweep],boxes[j,sweep])
+    width,height=(sweep_size,other_size) if sweep==0 else (other_size,sweep_size)
+    
+    area=np.clip(width,0,None)*np.clip(height,0,None)
+    box_area=size[:,0]*size[:,1]
+    min_area=np.maximum(np.minimum(box_area[i],box_area[j]),np.finfo(float).tiny)
+    overlap=area/min_area>max_intersect_area
+    
+    return i[overlap],j[overlap],width[overlap],height[overlap]
+
+
+def _separate_boxes(boxes,max_intersect_area=0.1,max_iter=100):
+    """
+    Move the boxes until no pair overlaps more than max_intersect_area.
+    
+    In each iteration, both boxes of each overlapping pair are pushed
+    apart 3/4 of the overlap, along the direction (vertical or horizontal)
+    with the smaller overlap. The displacements of all the pairs are
+    applied at once. Separating the pairs a bit more than needed avoids
+    the slow convergence of crowded regions.
+    
+    Parameters
+    ----------
+    boxes: np.array
+        Array with shape (n, 4) with x0, y0, x1, y1 of each box.
+    max_intersect_area: float
+        Maximum fraction of the area of a box that can be overlapped.
+    max_iter: int
+        Maximum number of iterations.
+        
+    Returns
+    -------
+    shift: np.array
+        Array with shape (n, 2) with the displacement of each box.
+    converged: bool
+        Whether all the overlaps have been solved.
+    """
+    
+    boxes=np.array(boxes,dtype=np.float64)
+    shift=np.zeros((len(boxes),2))
+    for _ in range(max_iter):
+        i,j,width,height=_overlapping_pairs(boxes,max_intersect_area)
+        if len(i)==0:
+            return shift,True
+        
+        vertical=height<=width
+        axis=np.where(vertical,1,0)
+        #direction from box i to box j, upwards/rightwards if centered
+        center_i=boxes[i,axis]+boxes[i,axis+2]
+        center_j=boxes[j,axis]+boxes[j,axis+2]
+        direction=np.where(center_j>=center_i,1.,-1.)
+        push=0.75*np.where(vertical,height,width)*direction
+        
+        step=np.zeros((len(boxes),2))
+        np.add.at(step,(j,axis),push)
+        np.add.at(step,(i,axis),-push)
+        shift+=step
+        boxes+=np.tile(step,2)
+        
+    return shift,len(_overlapping_pairs(boxes,max_intersect_area)[0])==0
+
+
+@timed()
+def resolve_bbox_overlap(fig,ax,txts=None,max_intersect_area=0.1,max_iter=100,draw_lines=True):
+    """
+    Avoid overlap between boxes of different texts. Unlike 
+    avoid_bbox_overlap, which tests every pair of texts, the boxes are 
+    kept in arrays, the overlapping pairs are found with a sweep line
+    and all the texts are moved at once in each iteration, so it can be
+    used with thousands of texts.
+    
+    Parameters
+    ----------
+    fig: matplotlib.pyplot.figure
+        Figure
+    ax: matplotlib.pyplot.axis
+        Axis with the texts
+    txts: list or None
+        Texts to move. If None, all the texts of ax except the title.
+    max_intersect_area: float
+        Maximum fraction of the area of a text box that can be overlapped.
+    max_iter: int
+        Maximum number of iterations.
+    draw_lines: bool
+        If True, draw a gray line from the old to the new position
+        of each moved text.
+        
+    Returns
+    -------
+    fig: matplotlib.pyplot.figure
+        Figure
+    ax: matplotlib.pyplot.axis
+        Axis
+    """
+    
+    if txts==None:
+        txts=_axes_texts(ax)
+    if len(txts)==0:
+        return fig,ax
+        
+    count("resolve_bbox_overlap","texts",len(txts))
+    #boxes in display coordinates (pixels)
+    boxes=measure_text_extents(fig,txts)
+    shift,converged=_separate_boxes(boxes,max_intersect_area,max_iter)
+    if not converged:
+        log("resolve_bbox_overlap","not possible to move all the texts")
+
+    moved=np.flatnonzero(np.any(shift!=0,axis=1))
+    segments=[]
+    for itxt in moved:
+        txt=txts[itxt]
+        trans=txt.get_transform()
+        old_pos=trans.transform(txt.get_unitless_position())
+        new_pos=old_pos+shift[itxt]
+        txt.set_position(trans.inverted().transform(new_pos))
+        segments.append([old_pos,new_pos])
+        
+    if draw_lines and len(segments)>0:
+        #lines in data coordinates
+        segments=ax.transData.inverted().transform(np.reshape(segments,(-1,2))).reshape(-1,2,2)
+        ax.add_collection(LineCollection(segments,colors="gray"),autolim=False)
+
+    return fig,ax
+
+
+class _label_index:
+    """
+    Final boxes (display coordinates) of the texts placed in an axes by
+    insert_labels, with a grid of buckets to find the boxes close to a
+    new one. It is valid while the view limits, the position of the axes
+    and the dpi do not change.
+    """
+    
+    def __init__(self,fig,ax,txts):
+        self.key=self._view_key(fig,ax)
+        self.txts=list(txts)
+        self.boxes=measure_text_extents(fig,self.txts) if len(self.txts)>0 else np.empty((0,4))
+        self.cell_size=None
+        self.cells={}
+        for itxt in range(len(self.txts)):
+            self._add_to_cells(itxt)
+            
+    @staticmethod
+    def _view_key(fig,ax):
+        return (tuple(ax.viewLim.bounds),tuple(ax.bbox.bounds),fig.dpi)
+    
+    def is_valid(self,fig,ax):
+        return self.key==self._view_key(fig,ax)
+    
+    def _cell_range(self,box):
+        low=np.floor(box[:2]/self.cell_size).astype(int)
+        high=np.floor(box[2:]/self.cell_size).astype(int)
+        return itertools.product(range(low[0],high[0]+1),range(low[1],high[1]+1))
+    
+    def _add_to_cells(self,itxt):
+        if self.cell_size==None:
+            #about the size of a text, so a box is in a few buckets
+            self.cell_size=max(float(np.median(np.max(self.boxes[:,2:]-self.boxes[:,:2],axis=1))),1.)
+        for cell in self._cell_range(self.boxes[itxt]):
+            self.cells.setdefault(cell,[]).append(itxt)
+            
+    def add(self,txts,boxes):
+        start=len(self.txts)
+        self.txts.extend(txts)
+        self.boxes=np.concatenate([self.boxes,boxes])
+        for itxt in range(start,len(self.txts)):
+            self._add_to_cells(itxt)
+            
+    def neighbours(self,box):
+        """Index of the boxes in the buckets covered by box."""
+        if self.cell_size==None:
+            #no box indexed yet
+            return np.array([],dtype=int)
+        close=set()
+        for cell in self._cell_range(box):
+            close.update(self.cells.get(cell,()))
+        return np.fromiter(close,dtype=int,count=len(close))
+
+def _intersections(boxes_i,boxes_j,max_intersect_area):
+    """
+    Whether each box of boxes_i (shape (n, 4)) overlaps each box of
+    boxes_j (shape (m, 4)) more than max_intersect_area times the area
+    of the smaller box. Returns an array with shape (n, m).
+    """
+    boxes_i,boxes_j=boxes_i[:,None,:],boxes_j[None,:,:]
+    width=np.minimum(boxes_i[...,2],boxes_j[...,2])-np.maximum(boxes_i[...,0],boxes_j[...,0])
+    height=np.minimum(boxes_i[...,3],boxes_j[...,3])-np.maximum(boxes_i[...,1],boxes_j[...,1])
+    area=np.clip(width,0,None)*np.clip(height,0,None)
+    area_i=(boxes_i[...,2]-boxes_i[...,0])*(boxes_i[...,3]-boxes_i[...,1])
+    area_j=(boxes_j[...,2]-boxes_j[...,0])*(boxes_j[...,3]-boxes_j[...,1])
+    min_area=np.maximum(np.minimum(area_i,area_j),np.finfo(float).tiny)
+    return area/min_area>max_intersect_area
+
+
+def _ring_offsets(ring,width,height):
+    """
+    Displacements of a box of size width x height to the positions of
+    a ring around it, at ring steps of half its size, closest first.
+    """
+    if ring==0:
+        return np.zeros((1,2))
+    steps=np.arange(-ring,ring+1)
+    ix,iy=np.meshgrid(steps,steps)
+    border=np.maximum(np.abs(ix),np.abs(iy))==ring
+    offsets=np.column_stack([ix[border]*width/2,iy[border]*height/2])
+    return offsets[np.argsort(np.hypot(*offsets.T),kind="stable")]
+
+
+@timed()
+def insert_labels(fig,ax,txts,max_intersect_area=0.1,max_iter=100,draw_lines=True):
+    """
+    Place new texts in an axes avoiding the overlap with the texts already
+    placed, which are not moved. Each new text is moved to the closest
+    position (in steps of half its size) where it does not overlap. The
+    final boxes of the texts are kept in the axes with a grid of buckets,
+    so each new text is only compared with the texts close to it, and
+    adding a few texts to an axes with thousands does not resolve all of
+    them again. The boxes are measured
+    again only if the view limits, the position of the axes or the dpi
+    change.
+    
+    The first call uses as placed texts all the texts of ax (except the
+    title) that are not in txts.
+    
+    Parameters
+    ----------
+    fig: matplotlib.pyplot.figure
+        Figure
+    ax: matplotlib.pyplot.axis
+        Axis with the texts
+    txts: list
+        New texts to place. They must be already added to ax.
+    max_intersect_area: float
+        Maximum fraction of the area of a text box that can be overlapped.
+    max_iter: int
+        Maximum number of rings of positions tried around each text.
+    draw_lines: bool
+        If True, draw a gray line from the old to the new position
+        of each moved text.
+        
+    Returns
+    -------
+    fig: matplotlib.pyplot.figure
+        Figure
+    ax: matplotlib.pyplot.axis
+        Axis
+        
+    Example
+    -------
+    >>> for x,y,name in sources:
+    >>>     txt=ax.text(x,y,name)
+    >>>     insert_labels(fig,ax,[txt])
+    """
+    
+    index=getattr(ax,"_label_index",None)
+    new_ids=set(id(txt) for txt in txts)
+    if index==None:
+        index=_label_index(fig,ax,[txt for txt in _axes_texts(ax) if id(txt) not in new_ids])
+    elif not index.is_valid(fig,ax):
+        count("insert_labels","rebuilt")
+        #texts removed from the axes are forgotten
+        index=_label_index(fig,ax,[txt for txt in index.txts if txt.axes is ax and id(txt) not in new_ids])
+    ax._label_index=index
+    
+    indexed_ids=set(id(txt) for txt in index.txts)
+    txts=[txt for txt in txts if id(txt) not in indexed_ids]
+    if len(txts)==0:
+        return fig,ax
+    count("insert_labels","texts",len(txts))
+    
+    boxes=measure_text_extents(fig,txts)
+    shift=np.zeros((len(txts),2))
+    for itxt,box in enumerate(boxes):
+        width,height=box[2]-box[0],box[3]-box[1]
+        placed=False
+        #positions closer to the original one are tried first
+        for ring in range(max_iter):
+            offsets=_ring_offsets(ring,width,height)
+            candidates=box+np.tile(offsets,2)
+            extent=np.concatenate([candidates[:,:2].min(axis=0),candidates[:,2:].max(axis=0)])
+            close=index.neighbours(extent)
+            if len(close)>0:
+                free=~np.any(_intersections(candidates,index.boxes[close],max_intersect_area),axis=1)
+            else:
+                free=np.ones(len(candidates),dtype=bool)
+            if np.any(free):
+                shift[itxt]=offsets[np.argmax(free)]
+                placed=True
+                break
+        if not placed:
+            log("insert_labels","not possible to move the text %s",txts[itxt].get_text())
+        #the next new texts avoid this one
+        index.add([txts[itxt]],(box+np.tile(shift[itxt],2))[None,:])
+        
+    segments=[]
+    for itxt in np.flatnonzero(np.any(shift!=0,axis=1)):
+        txt=txts[itxt]
+        trans=txt.get_transform()
+        old_pos=trans.transform(txt.get_unitless_position())
+        new_pos=old_pos+shift[itxt]
+        txt.set_position(trans.inverted().transform(new_pos))
+        segments.append([old_pos,new_pos])
+        
+    if draw_lines and len(segments)>0:
+        segments=ax.transData.inverted().transform(np.reshape(segments,(-1,2))).reshape(-1,2,2)
+        ax.add_collection(LineCollection(segments,colors="gray"),autolim=False)
+        
+    return fig,ax
+
+
+_2COOL_RCPARAMS={
+    'font.weight': "normal", #
+    'font.size': 16,
+#     "font.family": "Helvetica",    
+#     "font.family": {"serif": 'Computer Modern'},    
+    'text.usetex': False,              # use latex for all text handling
+    'figure.titlesize': 16,            # size of the figure title
+    'axes.linewidth' : 1.5,            # edge line width
+    'axes.labelweight': "normal",      # weight of the x and y labels
+    'axes.titlesize': 16,              # font size of the axes title
+    'axes.labelsize': 16,              # font size of the x and y labels
+    'axes.grid': True,                 # display grid or not
+    'axes.grid.axis': "both",          # which axis the grid should apply to
+    'axes.grid.which': "major",        # grid lines at {major, minor, both} ticks
+    'xtick.top': True,                 # draw x ticks on the top side
+    'xtick.bottom': True,              # draw x ticks on the bottom side
+    'ytick.right': True,               # draw y ticks on the right side
+    'ytick.left': True,                # draw y ticks on the right side
+    'xtick.direction': "in",           # x ticks direction: {in, out, inout} 
+    'ytick.direction': "in",           # y ticks direction: {in, out, inout} 
+    'xtick.major.width': 1.5,          # x major tick width in points
+    'ytick.major.width': 1.5,          # y major tick width in points
+    'xtick.minor.width': 1.5,          # x minor tick width in points    
+    'ytick.minor.width': 1.5,          # y minor tick width in points
+    'xtick.major.size': 8,             # x major tick size in points
+    'ytick.major.size': 8,             # y major tick size in points    
+    'xtick.minor.size': 5,             # x minor tick size in points
+    'ytick.minor.size': 5,             # y minor tick size in points    
+    'xtick.major.pad': 7.5,            # distance to x major tick label in points
+    'ytick.major.pad': 7.5,            # distance to y major tick label in points
+    'xtick.minor.pad': 7.5,            # distance to the x minor tick label in points    
+    'ytick.minor.pad': 7.5,            # distance to the y minor tick label in points
+    'xtick.labelsize': 16,             # font size of the x tick labels
+    'ytick.labelsize': 16,             # font size of the y tick labels
+    'lines.linewidth': 2,              # line width in points
+}
+
+#whether the backend has been initialized in this process, see _init_backend
+_BACKEND_INITIALIZED=False
+
+
+def _init_backend():
+    """
+    Create and close a figure the first time it is called in the process.
+    Solve bug legend fontsize not updated: the backend can change the
+    rcParams when the first figure is created, so it has to be done before
+    updating them.
+    """
+    global _BACKEND_INITIALIZED
+    if not _BACKEND_INITIALIZED:
+        fig,ax=plt.subplots()
+        plt.close(fig)
+        _BACKEND_INITIALIZED=True
+
+
+def _set_rcParams(rc):
+    """Write already validated rcParams without validating them again."""
+    setter=getattr(matplotlib.rcParams,"_set",None)
+    for k,v in rc.items():
+        if setter!=None:
+            setter(k,v)
+        else:
+            dict.__setitem__(matplotlib.rcParams,k,v)
+
+
+class rcParams_style:
+    """
+    Set of rcParams validated once when the style is created, so it can
+    be applied many times cheaply: permanently (apply), temporarily (with
+    statement) or while a function runs (decorator). Applying it does not
+    create any figure, and the style can be pickled to send it to worker
+    processes.
+    
+    The rcParams are global to the process: do not switch styles from
+    different threads at the same time.
+    
+    Example
+    -------
+    >>> style=rcParams_style(**{'font.size': 20})
+    >>> with style:
+    >>>     fig,ax=plt.subplots()
+    >>> @style
+    >>> def plot_run(run):
+    >>>     ...
+    """
+    
+    def __init__(self,rc={},use_2cool=True,**kwargs):
+        """
+        Parameters
+        ----------
+        rc: dict
+            rcParams of the style.
+        use_2cool: bool
+            If True, start from the rcParams of update_2cool_rcParams and
+            update them with rc and kwargs.
+        kwargs: dict
+            Additional rcParams.
+        """
+        dict_rcParams=dict(_2COOL_RCPARAMS) if use_2cool else {}
+        dict_rcParams.update(rc)
+        dict_rcParams.update(kwargs)
+        #validation done once, here
+        validated=matplotlib.RcParams()
+        for k,v in dict_rcParams.items():
+            validated[k]=v
+        self.rc={k:dict.__getitem__(validated,k) for k in dict_rcParams}
+        self._saved=[]
+        
+    def __getstate__(self):
+        return {"rc":self.rc}
+        
+    def __setstate__(self,state):
+        self.rc=state["rc"]
+        self._saved=[]
+        
+    def apply(self):
+        """Update the rcParams permanently with the style."""
+        _init_backend()
+        _set_rcParams(self.rc)
+        
+    def __enter__(self):
+        _init_backend()
+        self._saved.append({k:dict.__getitem__(matplotlib.rcParams,k) for k in self.rc})
+        _set_rcParams(self.rc)
+        return self
+    
+    def __exit__(self,exc_type,exc_value,exc_traceback):
+        _set_rcParams(self._saved.pop())
+        
+    def __call__(self,func):
+        """Use the style while func runs."""
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with self:
+                return func(*args,**kwargs)
+        return wrapper
+
+
+#style of update_2cool_rcParams without additional parameters
+_DEFAULT_2COOL_STYLE=None
+
+
 def update_2cool_rcParams(**kwargs):
     """
     Parameters
@@ -114,53 +734,68 @@ def update_2cool_rcParams(**kwargs):
     Dictionary with addition parameters to add to the rcParams, or change any
     parameter already in the dict.
     """
-    dict_rcParams={
-        'font.weight': "normal", #
-        'font.size': 16,
-    #     "font.family": "Helvetica",    
-    #     "font.family": {"serif": 'Computer Modern'},    
-        'text.usetex': False,              # use latex for all text handling
-        'figure.titlesize': 16,            # size of the figure title
-        'axes.linewidth' : 1.5,            # edge line width
-        'axes.labelweight': "normal",      # weight of the x and y labels
-        'axes.titlesize': 16,              # font size of the axes title
-        'axes.labelsize': 16,              # font size of the x and y labels
-        'axes.grid': True,                 # display grid or not
-        'axes.grid.axis': "both",          # which axis the grid should apply to
-        'axes.grid.which': "major",        # grid lines at {major, minor, both} ticks
-        'xtick.top': True,                 # draw x ticks on the top side
-        'xtick.bottom': True,              # draw x ticks on the bottom side
-        'ytick.right': True,               # draw y ticks on the right side
-        'ytick.left': True,                # draw y ticks on the right side
-        'xtick.direction': "in",           # x ticks direction: {in, out, inout} 
-        'ytick.direction': "in",           # y ticks direction: {in, out, inout} 
-        'xtick.major.width': 1.5,          # x major tick width in points
-        'ytick.major.width': 1.5,          # y major tick width in points
-        'xtick.minor.width': 1.5,          # x minor tick width in points    
-        'ytick.minor.width': 1.5,          # y minor tick width in points
-        'xtick.major.size': 8,             # x major tick size in points
-        'ytick.major.size': 8,             # y major tick size in points    
-        'xtick.minor.size': 5,             # x minor tick size in points
-        'ytick.minor.size': 5,             # y minor tick size in points    
-        'xtick.major.pad': 7.5,            # distance to x major tick label in points
-        'ytick.major.pad': 7.5,            # distance to y major tick label in points
-        'xtick.minor.pad': 7.5,            # distance to the x minor tick label in points    
-        'ytick.minor.pad': 7.5,            # distance to the y minor tick label in points
-        'xtick.labelsize': 16,             # font size of the x tick labels
-        'ytick.labelsize': 16,             # font size of the y tick labels
-        'lines.linewidth': 2,              # line width in points
-    }
+    global _DEFAULT_2COOL_STYLE
+    if len(kwargs)==0:
+        if _DEFAULT_2COOL_STYLE==None:
+            _DEFAULT_2COOL_STYLE=rcParams_style()
+        style=_DEFAULT_2COOL_STYLE
+    else:
+        style=rcParams_style(**kwargs)
     
-    for k,v in zip(kwargs.keys(),kwargs.values()):
-        dict_rcParams[k]=v    
+    style.apply()
+    
+    
+def _border_positions(fig,axs,txts,locs,x_interval,y_interval,renderer=None):
+    """
+    Vectorized version of text_in_figure_borders for many texts, each one
+    in its axes. The texts are measured together and the positions of all
+    of them are computed at once, in log space for axes with log scale.
+    
+    Returns
+    -------
+    pos_x, pos_y: np.array
+        Position of each text in data coordinates of its axes.
+    """
+    
+    available_locs=["lower left","lower right","upper left","upper right"]
+    for loc in locs:
+        if loc not in available_locs:
+            raise ValueError("Error, available values or loc are: lower left,"+\
+                             " lower right, upper left, upper right")
+    
+    if renderer==None:
+        renderer=_get_renderer(fig)
+    extents=measure_text_extents(fig,txts,renderer)
+
+    #properties of each axes, computed once per axes
+    ax_props={}
+    for ax in axs:
+        if ax not in ax_props:
+            bbox_ax=ax.get_window_extent(renderer)
+            ax_props[ax]=(*ax.get_xlim(),*ax.get_ylim(),ax.get_xscale()=="log",ax.get_yscale()=="log",
+                          bbox_ax.width,bbox_ax.height)
+    xmin,xmax,ymin,ymax,xlog,ylog,width_ax,height_ax=[np.array(prop) for prop in zip(*[ax_props[ax] for ax in axs])]
     
-    #solve bug legend fontsize not updated
-    fig,ax=plt.subplots()
-    plt.close()
+    frac_hor_size_t=(extents[:,2]-extents[:,0])/width_ax
+    frac_ver_size_t=(extents[:,3]-extents[:,1])/height_ax
+    x_interval=np.where(frac_hor_size_t/2>x_interval,frac_hor_size_t/2+x_interval,x_interval)
+    y_interval=np.where(frac_ver_size_t/2>y_interval,frac_ver_size_t/2+y_interval,y_interval)
 
-    matplotlib.rcParams.update(dict_rcParams)
+    left=np.array([loc.endswith("left") for loc in locs])
+    lower=np.array([loc.startswith("lower") for loc in locs])
     
+    #log and exp only of the axes with log scale
+    xmin,xmax,ymin,ymax=[limit.astype(np.float64) for limit in (xmin,xmax,ymin,ymax)]
+    xmin[xlog],xmax[xlog]=np.log(xmin[xlog]),np.log(xmax[xlog])
+    ymin[ylog],ymax[ylog]=np.log(ymin[ylog]),np.log(ymax[ylog])
+    pos_x=np.where(left,xmin+x_interval*(xmax-xmin),xmax-x_interval*(xmax-xmin))
+    pos_y=np.where(lower,ymin+y_interval*(ymax-ymin),ymax-y_interval*(ymax-ymin))
+    pos_x[xlog]=np.exp(pos_x[xlog])
+    pos_y[ylog]=np.exp(pos_y[ylog])
     
+    return pos_x,pos_y
+
+
 def text_in_figure_borders(fig,ax,text,loc,x_interval=10,y_interval=10):
     """
     Function that finds the x and y position in the figure
@@ -178,74 +813,69 @@ def text_in_figure_borders(fig,ax,text,loc,x_interval=10,y_interval=10):
         interval in the y-axis        
     """
     
-    xmin,xmax=ax.get_xlim()
-    ymin,ymax=ax.get_ylim()
-
-    dx=xmax-xmin
-    dy=ymax-ymin
-
-    r = fig.canvas.get_renderer()
+    pos_x,pos_y=_border_positions(fig,[ax],[text],[loc],x_interval,y_interval)
+    
+    return pos_x[0], pos_y[0]
     
-    bbox_text=text.get_window_extent(r)
-    bbox_ax=ax.get_window_extent(r)
     
-    frac_hor_size_t=bbox_text.width/bbox_ax.width
-    frac_ver_size_t=bbox_text.height/bbox_ax.height
+@timed()
+def place_texts(fig,entries,x_interval=1/20,y_interval=1/20,update_layout=False,**kwargs):
+    """
+    Place many texts in the borders of their axes at once. Same as
+    calling text_in_figure_borders for each text, but the renderer is
+    obtained once and all the positions are computed together.
     
-    if frac_hor_size_t/2>x_interval:
-        x_interval=frac_hor_size_t/2+x_interval
-    if frac_ver_size_t/2>y_interval:
-        y_interval=frac_ver_size_t/2+y_interval
+    Parameters
+    ----------
+    fig: matplotlib.pyplot.figure
+        Figure
+    entries: list
+        List of (ax, text, loc) with the axes, the text (str or 
+        matplotlib.text.Text already in ax) and its location: lower 
+        left/right, upper left/right.
+    x_interval: int, float
+        interval in the x-axis
+    y_interval: int, float
+        interval in the y-axis
+    update_layout: bool
+        If True and the figure has a layout engine (tight, constrained),
+        the layout is updated once before computing the positions, so 
+        they are correct for the final position of the axes.
+    kwargs
+        Kwargs passed to ax.text for the str texts.
         
-    if loc=="lower left":
-        if ax.get_xscale()=="linear":
-            pos_x=xmin+dx*(x_interval)
-        if ax.get_xscale()=="log":
-            pos_x=np.exp(np.log(xmin)+(x_interval)*(np.log(xmax)-np.log(xmin)))
-            
-        if ax.get_yscale()=="linear":
-            pos_y=ymin+dy*(y_interval)
-        if ax.get_yscale()=="log":
-            pos_y=np.exp(np.log(ymin)+(y_interval)*(np.log(ymax)-np.log(ymin)))
-            
-    elif loc=="lower right":
-        if ax.get_xscale()=="linear":       
-            pos_x=xmax-dx*(x_interval)
-        if ax.get_xscale()=="log":
-            pos_x=np.exp(np.log(xmax)-(x_interval)*(np.log(xmax)-np.log(xmin)))
-        
-        if ax.get_yscale()=="linear":       
-            pos_y=ymin+dy*(y_interval)
-        if ax.get_yscale()=="log":
-            pos_y=np.exp(np.log(ymin)+(y_interval)*(np.log(ymax)-np.log(ymin)))
-            
-    elif loc=="upper left":
-        if ax.get_xscale()=="linear":
-            pos_x=xmin+dx*(x_interval)
-        if ax.get_xscale()=="log":
-            pos_x=np.exp(np.log(xmin)+(x_interval)*(np.log(xmax)-np.log(xmin)))
-            
-        if ax.get_yscale()=="linear":        
-            pos_y=ymax-dy*(y_interval)
-        if ax.get_yscale()=="log":     
-            pos_y=np.exp(np.log(ymax)-(y_interval)*(np.log(ymax)-np.log(ymin)))
-            
-    elif loc=="upper right":
-        if ax.get_xscale()=="linear":
-            pos_x=xmax-dx*(x_interval)
-        if ax.get_xscale()=="log":
-            pos_x=np.exp(np.log(xmax)-(x_interval)*(np.log(xmax)-np.log(xmin)))
-            
-        if ax.get_yscale()=="linear":        
-            pos_y=ymax-dy*(y_interval)
-        if ax.get_yscale()=="log": 
-            pos_y=np.exp(np.log(ymax)-(y_interval)*(np.log(ymax)-np.log(ymin)))        
-            
-    else:
-        raise ValueError("Error, available values or loc are: lower left,"+\
-                         " lower right, upper left, upper right")
+    Returns
+    -------
+    txts: list
+        List with the matplotlib.text.Text placed.
+    """
     
-    return pos_x, pos_y
+    text_kwargs={
+        "size":20,
+        "horizontalalignment":'center',
+        "verticalalignment":'center',
+        "zorder":1000,
+    }
+    
+    text_kwargs.update(kwargs)
+    
+    if len(entries)==0:
+        return []
+        
+    axs,txts,locs=[],[],[]
+    for ax,text,loc in entries:
+        if not isinstance(text,matplotlib.text.Text):
+            text=ax.text(0.1,0.1,text,**text_kwargs)
+        axs.append(ax)
+        txts.append(text)
+        locs.append(loc)
+        
+    renderer=_get_renderer(fig,update_layout)
+    pos_x,pos_y=_border_positions(fig,axs,txts,locs,x_interval,y_interval,renderer)
+    for t,x,y in zip(txts,pos_x,pos_y):
+        t.set_position((x,y))
+        
+    return txts
     
     
 def plot_parameter_value(fig,ax,latex_symbol,value,loc="lower left",value_error=None, **kwargs):
@@ -380,17 +1010,21 @@ def add_panel_labels(fig,label_style="alphabet",loc="lower left", **kwargs):
     text_kwargs.update(kwargs)
                                
                                
+    entries=[]
     for text_print, iax in zip(label_list,axs_list):
-    
-        t=iax.text(0.1,0.1,text_print, **text_kwargs)
-        x_interval=1/10
-        y_interval=1/10
+        entries.append((iax,iax.text(0.1,0.1,text_print, **text_kwargs),loc))
         
-        pos_x,pos_y=text_in_figure_borders(fig,iax,t,loc,x_interval,y_interval)
+    x_interval=1/10
+    y_interval=1/10
+    
+    place_texts(fig,entries,x_interval,y_interval)
 
-        t.set_position((pos_x,pos_y))
 
+#font size of the PRELIMINARY text per pixel of axes width, see plot_preliminary_text
+_PRELIMINARY_SIZE_CACHE={}
 
+
+@timed()
 def plot_preliminary_text(fig,ax):
     """
     Plot the word PRELIMINARY diagonally in the plot
@@ -408,7 +1042,9 @@ def plot_preliminary_text(fig,ax):
         Axis used to store the figure    
     """
     
-    rotation_angle=np.rad2deg(np.arctan(ax.bbox.height/ax.bbox.width))
+    r = _get_renderer(fig)
+    aspect_ratio=ax.bbox.height/ax.bbox.width
+    rotation_angle=np.rad2deg(np.arctan(aspect_ratio))
     text_kwargs={
         "rotation":rotation_angle,
         "alpha":0.5,
@@ -430,51 +1066,88 @@ def plot_preliminary_text(fig,ax):
     elif ax.get_xscale()=="linear":
         xmidpoint=(xmin+xmax)/2
     else:
-        print("The specified xscale is not an option...")
+        log("plot_preliminary_text","the specified xscale is not an option")
 
     if ax.get_yscale()=="log":
         ymidpoint=(ymin*ymax)**0.5        
     elif ax.get_yscale()=="linear":
         ymidpoint=(ymin+ymax)/2
     else:
-        print("The specified yscale is not an option...")
+        log("plot_preliminary_text","the specified yscale is not an option")
         
     t=ax.text(xmidpoint,ymidpoint,text,**text_kwargs)
 
-    r = fig.canvas.get_renderer()
-    bb_ax=ax.get_tightbbox(r)    
-    bb = t.get_window_extent(renderer=r)
-    #transform to axis coordinates, 
-    #(0, 0) is bottom left of the figure, 
-    #and (1, 1) is top right of the figure.
-    bb = Bbox(ax.transAxes.inverted().transform(bb))
-    print(bb.width,bb.height)
-
-#     while bb.width>bb_ax.width or bb.height>bb_ax.height:
-    while bb.width>0.9 or bb.height>0.9:
-        old_size=t.get_size()
-        t.set_size(old_size-5)
-        bb = t.get_window_extent(renderer=r)    
-        bb = Bbox(ax.transAxes.inverted().transform(bb))
-        
-#     while bb.width<0.75*bb_ax.width or bb.height<0.75*bb_ax.height:
-    while bb.width<0.8 or bb.height<0.8:
-        old_size=t.get_size()
-        t.set_size(old_size+5)
-        bb = t.get_window_extent(renderer=r)
-        bb = Bbox(ax.transAxes.inverted().transform(bb))
-
-    print(bb.width,bb.height)
+    #the size of the text in axes units only depends on the aspect ratio
+    #of the axes (rotation), the dpi and the font. The font size per pixel 
+    #of axes width is stored for each of them.
+    font=t.get_fontproperties()
+    key=(round(aspect_ratio,6),fig.dpi,tuple(font.get_family()),font.get_weight())
+    if key in _PRELIMINARY_SIZE_CACHE:
+        t.set_size(_PRELIMINARY_SIZE_CACHE[key]*ax.bbox.width)
+        return ax
+        
+    #the extent is proportional to the font size: scale the size to have
+    #the smaller of the width and height of the text covering 80-90% of 
+    #the axes (so both are at least 80%, as before). It is corrected at
+    #most once, and measured again after the correction
+    for iteration in range(2):
+        x0,y0,x1,y1=measure_text_extents(fig,[t],r)[0]
+        #transform to axis coordinates, 
+        #(0, 0) is bottom left of the figure, 
+        #and (1, 1) is top right of the figure.
+        width,height=(x1-x0)/ax.bbox.width,(y1-y0)/ax.bbox.height
+        if 0.8<=min(width,height)<=0.9 or iteration==1:
+            break
+        t.set_size(t.get_size()*0.85/min(width,height))
+        
+    _PRELIMINARY_SIZE_CACHE[key]=t.get_size()/ax.bbox.width
+    log("plot_preliminary_text","text size in axes units %s %s",width,height)
     return ax
 
 
-def manage_number_axes(data_shape,single_plot_figsize=None,nrows=None,ncols=None):
+def _template_axes_grid(n_axes,nrows,ncols,figsize,share_axes):
+    """
+    Build a figure with n_axes axes in a grid of nrows x ncols, creating
+    only the axes that are used.
+    """
+    fig=plt.figure(figsize=figsize)
+    #GridSpec of the figure, so the layout engines (constrained) use it
+    gs=GridSpec(nrows,ncols,figure=fig)
+    axs=[]
+    for i in range(n_axes):
+        irow,icol=divmod(i,ncols)
+        if share_axes:
+            #x axis shared in each column and y axis in each row
+            sharex=axs[icol] if irow>0 else None
+            sharey=axs[irow*ncols] if icol>0 else None
+            ax=fig.add_subplot(gs[irow,icol],sharex=sharex,sharey=sharey)
+            #tick labels only in the left column and the bottom axes of each column
+            ax.tick_params(labelleft=icol==0,labelbottom=i+ncols>=n_axes)
+        else:
+            ax=fig.add_subplot(gs[irow,icol])
+        axs.append(ax)
+        
+    return fig,np.array(axs)
+
+
+@timed()
+def manage_number_axes(data_shape,single_plot_figsize=None,nrows=None,ncols=None,template=False,share_axes=False):
 
     """
     data_shape
         array with the dimension equal to the number of axes to plot
     single_plot_figsize: tuple
         tuple with two entries, horizontal and vertial size of each plot
+    template: bool
+        If True, the axes are created from a GridSpec of the figure and
+        the unused axes are not created, so only the used axes are 
+        returned. The build time is about the same as without template
+        (most of it is creating the axes); use share_axes to reduce the
+        time of grids of many panels.
+    share_axes: bool
+        Only with template=True. If True, the axes share the x axis in each
+        column and the y axis in each row (limits and ticks), and only the
+        outer axes show tick labels, which are not drawn for every panel.
     """
 
     data_shape = np.array(data_shape)
@@ -503,7 +1176,14 @@ def manage_number_axes(data_shape,single_plot_figsize=None,nrows=None,ncols=None
     while nrows*ncols<data_shape.shape[0]:
         ncols+=1
 
-    print(nrows,ncols)
+    if template:
+        if single_plot_figsize==None:
+            figsize=tuple(matplotlib.rcParams["figure.figsize"])
+        else:
+            figsize=(single_plot_figsize[0]*ncols,single_plot_figsize[1]*nrows)
+        return _template_axes_grid(data_shape.shape[0],nrows,ncols,figsize,share_axes)
+
+    log("manage_number_axes","nrows %s ncols %s",nrows,ncols)
 
     if single_plot_figsize==None:
         fig,axs=plt.subplots(nrows=nrows,ncols=ncols)
@@ -522,10 +1202,365 @@ def manage_number_axes(data_shape,single_plot_figsize=None,nrows=None,ncols=None
     return fig, axs    
     
 
+def _chunked_limits(values,chunk_size,log):
+    """Minimum and maximum of the finite values (positive if log), chunk by chunk."""
+    vmin,vmax=np.inf,-np.inf
+    for i in range(0,len(values),chunk_size):
+        chunk=np.asarray(values[i:i+chunk_size],dtype=np.float64)
+        chunk=chunk[np.isfinite(chunk)&(chunk>0 if log else True)]
+        if len(chunk)>0:
+            vmin,vmax=min(vmin,chunk.min()),max(vmax,chunk.max())
+    if not np.isfinite(vmin):
+        raise ValueError("There are no valid values to plot")
+    if vmin==vmax:
+        vmin,vmax=(vmin/2,vmax*2) if log else (vmin-0.5,vmax+0.5)
+    return vmin,vmax
+
+
+@timed()
+def plot_density(fig,ax,x,y,bins=200,xlim=None,ylim=None,xscale="linear",yscale="linear",
+                 log_counts=True,chunk_size=1000000,colorbar=False,**kwargs):
+    """
+    Plot the density of a large number of points as a 2-dimensional 
+    histogram drawn as a single raster artist, instead of a scatter plot.
+    The drawing time and the file size do not depend on the number of
+    points. The points are binned in chunks, so the memory used is bounded.
+    
+    Parameters
+    ----------
+    fig: matplotlib.pyplot.figure
+        Figure
+    ax: matplotlib.pyplot.axis
+        Axis used to store the figure
+    x, y: np.array
+        Position of the points. It can be a np.memmap.
+    bins: int or tuple
+        Number of bins in each axis.
+    xlim, ylim: tuple or None
+        Range of the histogram. If None, the range of the points.
+    xscale, yscale: str
+        Scale of the axes: linear or log. The bins are uniform in the scale.
+    log_counts: bool
+        If True, use a log color scale for the counts.
+    chunk_size: int
+        Number of points binned at once.
+    colorbar: bool
+        If True, add a colorbar with the counts.
+    kwargs
+        Kwargs passed to ax.imshow (linear axes) or ax.pcolormesh (log axes),
+        e.g. cmap.
+    
+    Returns
+    -------
+    ax: matplotlib.pyplot.axis
+        Axis
+    artist: matplotlib.image.AxesImage or matplotlib.collections.QuadMesh
+        Artist with the histogram.
+    """
+    
+    for scale in [xscale,yscale]:
+        if scale not in ["linear","log"]:
+            raise ValueError("Error, available scales are: linear, log")
+    if len(x)!=len(y):
+        raise ValueError("x and y must have the same length")
+    nbins_x,nbins_y=(bins,bins) if np.ndim(bins)==0 else bins
+    xlog,ylog=xscale=="log",yscale=="log"
+    
+    if xlim==None:
+        xlim=_chunked_limits(x,chunk_size,xlog)
+    if ylim==None:
+        ylim=_chunked_limits(y,chunk_size,ylog)
+    #limits in the space where the bins are uniform
+    xlo,xhi=np.log10(xlim) if xlog else xlim
+    ylo,yhi=np.log10(ylim) if ylog else ylim
+    
+    counts=np.zeros(nbins_x*nbins_y,dtype=np.int64)
+    for i in range(0,len(x),chunk_size):
+        xc=np.asarray(x[i:i+chunk_size],dtype=np.float64)
+        yc=np.asarray(y[i:i+chunk_size],dtype=np.float64)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            if xlog:
+                xc=np.log10(xc)
+            if ylog:
+                yc=np.log10(yc)
+            ix=np.floor((xc-xlo)/(xhi-xlo)*nbins_x)
+            iy=np.floor((yc-ylo)/(yhi-ylo)*nbins_y)
+        #the upper edge is included in the last bin
+        ix[xc==xhi]=nbins_x-1
+        iy[yc==yhi]=nbins_y-1
+        valid=(ix>=0)&(ix<nbins_x)&(iy>=0)&(iy<nbins_y)
+        flat_index=iy[valid].astype(np.int64)*nbins_x+ix[valid].astype(np.int64)
+        counts+=np.bincount(flat_index,minlength=nbins_x*nbins_y)
+    counts=counts.reshape(nbins_y,nbins_x)
+
+    norm=None
+    if log_counts:
+        counts=np.ma.masked_equal(counts,0)
+        if counts.count()>0:
+            norm=LogNorm(vmin=1,vmax=counts.max())
+
+    ax.set_xscale(xscale)
+    ax.set_yscale(yscale)
+    if not xlog and not ylog:
+        artist=ax.imshow(counts,origin="lower",extent=(xlim[0],xlim[1],ylim[0],ylim[1]),
+                         aspect="auto",interpolation="nearest",norm=norm,**kwargs)
+    else:
+        x_edges=np.logspace(xlo,xhi,nbins_x+1) if xlog else np.linspace(xlo,xhi,nbins_x+1)
+        y_edges=np.logspace(ylo,yhi,nbins_y+1) if ylog else np.linspace(ylo,yhi,nbins_y+1)
+        artist=ax.pcolormesh(x_edges,y_edges,counts,norm=norm,rasterized=True,**kwargs)
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    
+    if colorbar:
+        fig.colorbar(artist,ax=ax,label="Counts")
+        
+    return ax,artist
+
+
+def _init_figure_writer():
+    """Worker processes of figure_writer render with Agg."""
+    matplotlib.use("Agg")
+    
+    
+def _save_figure(fig,file_name,kwargs):
+    """Save the figure, used by figure_writer in the background."""
+    fig.savefig(file_name,**kwargs)
+    return file_name
+
+
+class figure_writer:
+    """
+    Save figures in the background, so the next figure can be built
+    while the previous ones are rasterised, compressed and written.
+    
+    By default the figures are sent (pickled) to a pool of processes,
+    since the rendering of matplotlib keeps the GIL and would not run in
+    parallel with the main loop in a thread. Figures that cannot be 
+    pickled can be saved with threads (use_processes=False), which only 
+    overlaps the writing to disk.
+    
+    The number of figures waiting to be saved is bounded to limit the
+    memory used. Use flush (or the with statement) to wait until all the
+    figures are saved.
+    
+    Example
+    -------
+    >>> with figure_writer(max_pending=4) as writer:
+    >>>     for run in runs:
+    >>>         fig,axs=manage_number_axes(data_shape)
+    >>>         ...
+    >>>         writer.save(fig,f"run_{run}.png",dpi=200)
+    """
+    
+    def __init__(self,n_workers=2,max_pending=8,use_processes=True):
+        """
+        Parameters
+        ----------
+        n_workers: int
+            Number of processes (or threads) writing figures.
+        max_pending: int
+            Maximum number of figures waiting to be saved. save blocks
+            while this number is reached.
+        use_processes: bool
+            If True, save in processes. Else, in threads.
+        """
+        if use_processes:
+            self.pool=ProcessPoolExecutor(max_workers=n_workers,initializer=_init_figure_writer)
+        else:
+            self.pool=ThreadPoolExecutor(max_workers=n_workers)
+        self.slots=threading.BoundedSemaphore(max_pending)
+        self.futures=[]
+        
+    def save(self,fig,file_name,**kwargs):
+        """
+        Queue the figure to be saved. The figure is closed (removed from
+        pyplot) and must not be modified afterwards.
+        
+        Parameters
+        ----------
+        fig: matplotlib.pyplot.figure
+            Figure
+        file_name: str
+            Output file
+        kwargs
+            Kwargs passed to fig.savefig
+        """
+        self.slots.acquire()
+        #close in this thread, pyplot is not thread safe
+        plt.close(fig)
+        try:
+            future=self.pool.submit(_save_figure,fig,file_name,kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+            
+    def flush(self):
+        """
+        Wait until all the queued figures are saved.
+        
+        Returns
+        -------
+        file_names: list
+            Files written since the last flush.
+            
+        Raises the first error that happened while saving, if any.
+        """
+        futures,self.futures=self.futures,[]
+        file_names=[]
+        error=None
+        for future in futures:
+            try:
+                file_names.append(future.result())
+            except Exception as err:
+                if error==None:
+                    error=err
+        if error!=None:
+            raise error
+        return file_names
+        
+    def close(self):
+        """Wait for the queued figures and stop the workers."""
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,exc_type,exc_value,exc_traceback):
+        self.close()
+    
+
+class figure_template:
+    """
+    Figure whose static parts (axes grid, style, panel labels, 
+    PRELIMINARY text...) are drawn once, used to produce a series of
+    figures that only differ in their data. For each figure, the cached
+    background is restored, only the new artists are drawn (blitting)
+    and the figure is saved. The new artists are removed afterwards,
+    so the template is ready for the next figure.
+    
+    The autoscale of the axes is disabled: set the limits before creating
+    the template. The new artists are drawn over all the static ones
+    (e.g. the ticks and the frame of the axes). PNG files at the dpi of
+    the figure are written directly from the canvas buffer; other 
+    formats, dpi or savefig kwargs are saved with savefig. The property
+    cycles of the axes are restored after each figure, so each one starts
+    from the first default color as a new figure.
+    
+    Example
+    -------
+    >>> style=rcParams_style()
+    >>> with style:
+    >>>     fig,axs=manage_number_axes(data_shape,template=True)
+    >>>     for ax in axs:
+    >>>         ax.set_xlim(0,10)
+    >>>         ax.set_ylim(0,1)
+    >>>     add_panel_labels(fig)
+    >>> template=figure_template(fig,axs,style)
+    >>> def plot_run(fig,axs,run):
+    >>>     axs[0].plot(x[run],y[run])
+    >>>     plot_parameter_value(fig,axs[0],"alpha",alpha[run],value_error=alpha_err[run])
+    >>> for run in runs:
+    >>>     template.save(functools.partial(plot_run,run=run),f"run_{run}.png")
+    """
+    
+    def __init__(self,fig,axs=None,style=None):
+        """
+        Parameters
+        ----------
+        fig: matplotlib.pyplot.figure
+            Figure with the static parts already plotted.
+        axs: list or None
+            Axes where the data is plotted. If None, all the axes of fig.
+        style: rcParams_style or None
+            Style used while drawing. If None, the current rcParams.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        
+        self.fig=fig
+        self.axs=list(np.ravel(axs)) if axs is not None else list(fig.axes)
+        self.style=style
+        if not isinstance(fig.canvas,FigureCanvasAgg):
+            FigureCanvasAgg(fig)
+        for ax in self.axs:
+            ax.set_autoscale_on(False)
+        self.update_background()
+        
+    def _style(self):
+        return self.style if self.style!=None else contextlib.nullcontext()
+        
+    def update_background(self):
+        """Draw and cache the static parts again, e.g. after changing them."""
+        with self._style():
+            self.fig.canvas.draw()
+            self.background=self.fig.canvas.copy_from_bbox(self.fig.bbox)
+            
+    def _children(self):
+        return [set(map(id,ax.get_children())) for ax in self.axs]+[set(map(id,self.fig.get_children()))]
+        
+    @timed("figure_template.save")
+    def save(self,plot_func,file_name,**kwargs):
+        """
+        Plot the data of a figure of the series and save it.
+        
+        Parameters
+        ----------
+        plot_func: callable
+            Function that receives the figure and the axes, and adds the
+            data artists (lines, images, texts from plot_parameter_value...).
+            It must not modify the static parts.
+        file_name: str
+            Output file.
+        kwargs
+            Kwargs passed to fig.savefig. If any is given, or the file is
+            not a PNG, savefig is used instead of the canvas buffer.
+        """
+        import matplotlib.image
+        from pathlib import Path
+        
+        before=self._children()
+        #state of the property cycles (default colors...), restored after the figure
+        cycles=[(copy.deepcopy(ax._get_lines),copy.deepcopy(ax._get_patches_for_fill)) for ax in self.axs]
+        try:
+            with self._style():
+                plot_func(self.fig,self.axs)
+                new_artists=[]
+                for parent,ids in zip(self.axs+[self.fig],before):
+                    new_artists.extend(child for child in parent.get_children() if id(child) not in ids)
+                count("figure_template.save","artists",len(new_artists))
+                
+                if Path(file_name).suffix.lower()!=".png" or len(kwargs)>0:
+                    self.fig.savefig(file_name,**kwargs)
+                    return
+                
+                canvas=self.fig.canvas
+                canvas.restore_region(self.background)
+                renderer=canvas.get_renderer()
+                for artist in sorted(new_artists,key=lambda artist: artist.get_zorder()):
+                    if artist.get_visible():
+                        artist.draw(renderer)
+                matplotlib.image.imsave(file_name,np.asarray(canvas.buffer_rgba()),
+                                        dpi=self.fig.dpi,format="png")
+        finally:
+            for parent,ids in zip(self.axs+[self.fig],before):
+                for child in parent.get_children():
+                    if id(child) not in ids:
+                        child.remove()
+            for ax,(lines,patches) in zip(self.axs,cycles):
+                ax._get_lines,ax._get_patches_for_fill=lines,patches
+    
+
+@functools.lru_cache(maxsize=128)
 def correct_display_flux_units(flux_units):
     """
     Function to return units of an integral or differential flux in
     The usual way the units of the flux are defined: energy per cm-2 s-1.
+    
+    The result is cached for each unit (last 128 units).
 
     Parameters
     ----------
@@ -539,6 +1574,8 @@ def correct_display_flux_units(flux_units):
 
     """
 
+    import astropy.units as u
+
     units_string=flux_units.to_string("latex_inline")
 
     # split the string to get a list with the units (ex in one index: s^{-1})
@@ -585,3 +1622,27 @@ def correct_display_flux_units(flux_units):
 
     else:
         raise Exception("The units provided are not equivalent to E^power cm-2 s-1")
+
+
+def correct_display_flux_units_list(flux_units_list):
+    """
+    Apply correct_display_flux_units to a list of units. Each different
+    unit is formatted only once.
+
+    Parameters
+    ----------
+    flux_units_list: list
+        List of astropy.unit with the units of the fluxes
+
+    Returns
+    -------
+    results: list
+        List with the (energy_power, units_string) of each unit.
+
+    """
+
+    formatted={}
+    for flux_units in flux_units_list:
+        if flux_units not in formatted:
+            formatted[flux_units]=correct_display_flux_units(flux_units)
+    return [formatted[flux_units] for flux_units in flux_units_list]